@@ -5,12 +5,16 @@ camera calibration for distorted images with chess board samples
 reads distorted images, calculates the calibration and write undistorted images
 
 usage:
-    calibrate.py [--debug <output path>] [--square_size] [<image mask>]
+    calibrate.py [--debug <output path>] [--square_size] [--cache <cache path>] [--profile <profile path> --camera <1|2>] [<image mask>]
 
 default values:
     --debug:    ./output/
     --square_size: 1.0
+    --cache:    <image folder>/corner_cache (detected corners of previous runs, empty to disable)
     <image mask> defaults to './data/Cam_??.jpg'
+
+--profile writes the camera matrix and distortion coefficients to the calibration profile of the station
+for the given camera (created if necessary)
 '''
 
 # Python 2/3 compatibility
@@ -21,7 +25,7 @@ import numpy as np
 import cv2 as cv
 
 # local modules
-from common import splitfn
+from common import splitfn, CornerCache, update_profile
 
 # built-in modules
 import os
@@ -31,7 +35,7 @@ def main():
     import getopt
     from glob import glob
 
-    args, img_mask = getopt.getopt(sys.argv[1:], '', ['debug=', 'square_size=', 'threads='])
+    args, img_mask = getopt.getopt(sys.argv[1:], '', ['debug=', 'square_size=', 'threads=', 'cache=', 'profile=', 'camera='])
     args = dict(args)
     args.setdefault('--debug', './output/')
     args.setdefault('--square_size', 1.0)
@@ -46,6 +50,7 @@ def main():
     if debug_dir and not os.path.isdir(debug_dir):
         os.mkdir(debug_dir)
     square_size = float(args.get('--square_size'))
+    cache = CornerCache(args.get('--cache', os.path.join(os.path.dirname(img_names[0]), 'corner_cache')))
 
     pattern_size = (9, 6)
     pattern_points = np.zeros((np.prod(pattern_size), 3), np.float32)
@@ -57,7 +62,20 @@ def main():
     h, w = cv.imread(img_names[0], cv.IMREAD_GRAYSCALE).shape[:2]  # TODO: use imquery call to retrieve results
     #print(str(h)+' '+str(w))
 
+    term = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_COUNT, 30, 0.1)
+
     def processImage(fn):
+        # Skip detection for images already processed by a previous run
+        key = cache.key(fn, 'calibrate', pattern_size, term)
+        cached = cache.get(key)
+        if cached is not None:
+            shape, corners = cached
+            assert (h, w) == shape[:2], ("size: %d x %d ... " % (shape[1], shape[0]))
+            print('           %s... cached' % fn)
+            if corners is None:
+                return None
+            return (corners.reshape(-1, 2), pattern_points)
+
         print('processing %s... ' % fn)
         img = cv.imread(fn, 0)
         if img is None:
@@ -69,8 +87,8 @@ def main():
         assert w == img.shape[1] and h == img.shape[0], ("size: %d x %d ... " % (img.shape[1], img.shape[0]))
         found, corners = cv.findChessboardCorners(img, pattern_size)
         if found:
-            term = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_COUNT, 30, 0.1)
             cv.cornerSubPix(img, corners, (5, 5), (-1, -1), term)
+        cache.put(key, img.shape, corners if found else None)
 
         if debug_dir:
             vis = cv.cvtColor(img, cv.COLOR_GRAY2BGR)
@@ -107,6 +125,11 @@ def main():
     print("camera matrix:\n", camera_matrix)
     print("distortion coefficients: ", dist_coefs.ravel())
 
+    if '--profile' in args:
+        camera = args.get('--camera', '1')
+        update_profile(args.get('--profile'), **{'K' + camera: camera_matrix, 'd' + camera: dist_coefs, 'model' + camera: 'pinhole'})
+        print("Camera %s calibration written to %s" % (camera, args.get('--profile')))
+
     # undistort the image with the calibration
     print('')
     for fn in img_names if debug_dir else []:
@@ -17,6 +17,7 @@ import cv2 as cv
 
 # built-in modules
 import os
+import hashlib
 import itertools as it
 from contextlib import contextmanager
 
@@ -162,6 +163,60 @@ class StatValue:
             c = self.smooth_coef
             self.value = c * self.value + (1.0-c) * v
 
+class CornerCache:
+    '''On-disk cache of detected chess board corners, one .npz file per entry
+    Entries are keyed by the image content hash and the detection parameters (board size, flags...)'''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    def key(self, fn, *params):
+        '''Returns the cache key of an image file, None if it cannot be read'''
+        digest = hashlib.sha1()
+        try:
+            with open(fn, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        except (IOError, OSError):
+            return None
+        digest.update(repr(params).encode())
+        return digest.hexdigest()
+    def get(self, key):
+        '''Returns (image shape, corners or None if the board was not found), None if not cached'''
+        if not self.cache_dir or key is None:
+            return None
+        try:
+            with np.load(os.path.join(self.cache_dir, key + '.npz')) as data:
+                corners = data['corners'] if data['found'] else None
+                return tuple(data['shape']), corners
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+    def put(self, key, shape, corners):
+        if not self.cache_dir or key is None:
+            return
+        found = corners is not None
+        np.savez(os.path.join(self.cache_dir, key + '.npz'), shape=np.array(shape), found=found,
+                 corners=corners if found else np.zeros((0, 1, 2), np.float32))
+
+# Version of the Podonator calibration profile file format (see PodonatorLib.Profile)
+profile_version = 1
+
+def update_profile(fn, **values):
+    '''Writes values (K1, d1, model1...) to a Podonator calibration profile, creating it if necessary
+    Correction maps stored in the profile are dropped as they depend on the previous calibration'''
+    entries = {}
+    if os.path.exists(fn):
+        with np.load(fn) as data:
+            if 'version' in data.files and int(data['version']) > profile_version:
+                raise ValueError('Calibration profile %s needs a newer version of this script' % fn)
+            entries = dict((name, data[name]) for name in data.files if not name.startswith('map_'))
+    entries.update(values)
+    entries['version'] = profile_version
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        np.savez(f, **entries)
+    os.replace(tmp_fn, fn)
+
 class RectSelector:
     def __init__(self, win, callback):
         self.win = win
@@ -1,58 +1,148 @@
+#!/usr/bin/env python
+
+'''
+fisheye camera calibration with chess board samples
+
+usage:
+    fisheyeCalibration.py [--board <columns>x<rows>] [--processes] [--detect_width] [--cache <cache path>] [--profile <profile path> --camera <1|2>] [<image mask>]
+
+default values:
+    --board:        6x9 (inner corners of the chess board)
+    --processes:    number of CPU cores
+    --detect_width: 960 (width of the downscaled copy used to find the board, 0 to detect at full resolution)
+    --cache:        <image folder>/corner_cache (detected corners of previous runs, empty to disable)
+    <image mask> defaults to '*.png'
+
+--profile writes K and D to the calibration profile of the station for the given camera (created if necessary)
+'''
+
 import cv2
-assert cv2.__version__[0] == '3', 'The fisheye module requires opencv version >= 3.0.0'
+assert int(cv2.__version__.split('.')[0]) >= 3, 'The fisheye module requires opencv version >= 3.0.0'
 
 import numpy as np
 import os
 import glob
+import math
+import multiprocessing
+from functools import partial
 
-CHECKERBOARD = (6,9)
+# local modules
+from common import CornerCache, update_profile
 
 subpix_criteria = (cv2.TERM_CRITERIA_EPS+cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1)
 calibration_flags = cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC+cv2.fisheye.CALIB_CHECK_COND+cv2.fisheye.CALIB_FIX_SKEW
+detection_flags = cv2.CALIB_CB_ADAPTIVE_THRESH+cv2.CALIB_CB_FAST_CHECK+cv2.CALIB_CB_NORMALIZE_IMAGE
 
-objp = np.zeros((1, CHECKERBOARD[0]*CHECKERBOARD[1], 3), np.float32)
-objp[0,:,:2] = np.mgrid[0:CHECKERBOARD[0], 0:CHECKERBOARD[1]].T.reshape(-1, 2)
-
-_img_shape = None
-objpoints = [] # 3d point in real world space
-imgpoints = [] # 2d points in image plane.
+def find_corners(fname, checkerboard, detect_width):
+    '''Finds the chess board on a downscaled copy of the image then refines the corners at full resolution
+    Returns the file name, the image shape and the corners (None if the board was not found)'''
+    gray = cv2.imread(fname, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return fname, None, None
+    scale = 1.0
+    if detect_width and gray.shape[1] > detect_width:
+        scale = detect_width / gray.shape[1]
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        ret, corners = cv2.findChessboardCorners(small, checkerboard, detection_flags)
+        if ret:
+            # Back to full resolution pixel coordinates
+            corners = (corners + 0.5) / scale - 0.5
+        else:
+            scale = 1.0
+    if scale == 1.0:
+        ret, corners = cv2.findChessboardCorners(gray, checkerboard, detection_flags)
+    if not ret:
+        return fname, gray.shape[:2], None
+    # The search window must cover the error of the downscaled detection
+    win = max(3, int(math.ceil(2 / scale)))
+    cv2.cornerSubPix(gray, corners, (win, win), (-1, -1), subpix_criteria)
+    return fname, gray.shape[:2], corners
 
-images = glob.glob('*.png')
+def main():
+    import sys
+    import getopt
 
-for fname in images:
-    img = cv2.imread(fname)
-    if _img_shape == None:
-        _img_shape = img.shape[:2]
+    args, img_mask = getopt.getopt(sys.argv[1:], '', ['board=', 'processes=', 'detect_width=', 'cache=', 'profile=', 'camera='])
+    args = dict(args)
+    args.setdefault('--board', '6x9')
+    args.setdefault('--detect_width', 960)
+    if not img_mask:
+        img_mask = '*.png'  # default
     else:
-        assert _img_shape == img.shape[:2], "All images must share the same size."
-
-    gray = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-    # Find the chess board corners
-    ret, corners = cv2.findChessboardCorners(gray, CHECKERBOARD, cv2.CALIB_CB_ADAPTIVE_THRESH+cv2.CALIB_CB_FAST_CHECK+cv2.CALIB_CB_NORMALIZE_IMAGE)
-    # If found, add object points, image points (after refining them)
-    if ret == True:
-        objpoints.append(objp)
-        cv2.cornerSubPix(gray,corners,(3,3),(-1,-1),subpix_criteria)
-        imgpoints.append(corners)
-
-N_OK = len(objpoints)
-K = np.zeros((3, 3))
-D = np.zeros((4, 1))
-rvecs = [np.zeros((1, 1, 3), dtype=np.float64) for i in range(N_OK)]
-tvecs = [np.zeros((1, 1, 3), dtype=np.float64) for i in range(N_OK)]
-rms, _, _, _, _ = \
-    cv2.fisheye.calibrate(
-        objpoints,
-        imgpoints,
-        gray.shape[::-1],
-        K,
-        D,
-        rvecs,
-        tvecs,
-        calibration_flags,
-        (cv2.TERM_CRITERIA_EPS+cv2.TERM_CRITERIA_MAX_ITER, 30, 1e-6)
-    )
-print("Found " + str(N_OK) + " valid images for calibration")
-print("DIM=" + str(_img_shape[::-1]))
-print("K=np.array(" + str(K.tolist()) + ")")
-print("D=np.array(" + str(D.tolist()) + ")")
+        img_mask = img_mask[0]
+    checkerboard = tuple(int(n) for n in args.get('--board').lower().split('x'))
+    detect_width = int(args.get('--detect_width'))
+    processes = int(args['--processes']) if '--processes' in args else None
+
+    objp = np.zeros((1, checkerboard[0]*checkerboard[1], 3), np.float32)
+    objp[0,:,:2] = np.mgrid[0:checkerboard[0], 0:checkerboard[1]].T.reshape(-1, 2)
+
+    _img_shape = None
+    objpoints = [] # 3d point in real world space
+    imgpoints = [] # 2d points in image plane.
+
+    images = sorted(glob.glob(img_mask))
+    if not images:
+        sys.exit("No images found matching " + img_mask)
+
+    # Only detect corners in new or changed images
+    cache = CornerCache(args.get('--cache', os.path.join(os.path.dirname(images[0]), 'corner_cache')))
+    keys = {fname: cache.key(fname, 'fisheye', checkerboard, detection_flags, detect_width, subpix_criteria) for fname in images}
+    results = {}
+    for fname in images:
+        cached = cache.get(keys[fname])
+        if cached is not None:
+            results[fname] = (fname,) + cached
+    missing = [fname for fname in images if fname not in results]
+    print("%d images, %d cached, %d to process" % (len(images), len(results), len(missing)))
+    if missing:
+        with multiprocessing.Pool(processes) as pool:
+            for fname, shape, corners in pool.imap(partial(find_corners, checkerboard=checkerboard, detect_width=detect_width), missing):
+                results[fname] = (fname, shape, corners)
+                if shape is not None:
+                    cache.put(keys[fname], shape, corners)
+
+    for fname, shape, corners in (results[fname] for fname in images):
+        if shape is None:
+            print("Failed to load", fname)
+            continue
+        if _img_shape == None:
+            _img_shape = shape
+        else:
+            assert _img_shape == shape, "All images must share the same size."
+        # If found, add object points, image points
+        if corners is not None:
+            objpoints.append(objp)
+            imgpoints.append(corners)
+        else:
+            print("Chessboard not found in", fname)
+
+    N_OK = len(objpoints)
+    K = np.zeros((3, 3))
+    D = np.zeros((4, 1))
+    rvecs = [np.zeros((1, 1, 3), dtype=np.float64) for i in range(N_OK)]
+    tvecs = [np.zeros((1, 1, 3), dtype=np.float64) for i in range(N_OK)]
+    rms, _, _, _, _ = \
+        cv2.fisheye.calibrate(
+            objpoints,
+            imgpoints,
+            _img_shape[::-1],
+            K,
+            D,
+            rvecs,
+            tvecs,
+            calibration_flags,
+            (cv2.TERM_CRITERIA_EPS+cv2.TERM_CRITERIA_MAX_ITER, 30, 1e-6)
+        )
+    print("Found " + str(N_OK) + " valid images for calibration")
+    print("DIM=" + str(_img_shape[::-1]))
+    print("K=np.array(" + str(K.tolist()) + ")")
+    print("D=np.array(" + str(D.tolist()) + ")")
+
+    if '--profile' in args:
+        camera = args.get('--camera', '1')
+        update_profile(args.get('--profile'), **{'K' + camera: K, 'd' + camera: D, 'model' + camera: 'fisheye'})
+        print("Camera " + camera + " calibration written to " + args.get('--profile'))
+
+if __name__ == '__main__':
+    main()
@@ -8,33 +8,140 @@ import PodonatorLib
 
 '''
 usage:
-    Podonator.py [--left_camera_id] [--right_camera_id] [<output path>]
+    Podonator.py [--left_camera_id] [--right_camera_id] [--cameras <id,id...>] [--backend] [--profile] [--stats] [--acquire] [--burst] [--auto_capture] [--auto_capture_delay] [--max_skew] [--measure] [--patient <name>] [--record <name>] [--replay <name>] [--replay_speed] [--list_cameras] [--detect_reference] [--build_maps] [--check_correction] [<output path>]
 
 default values:
     --left_camera_id  : 0
     --right_camera_id : 1
+    --backend         : auto (DirectShow on Windows, V4L2 with MJPG on Linux), dshow, v4l2, any or file
+    --profile         : PODONATOR_PROFILE environment variable or podonator_profile.npz next to PodonatorLib.py
+    --acquire         : single (last frame), median or mean (temporal denoising of the last --burst frames of each camera)
+                        or sharpest (least blurred frame of each camera during the last second)
+    --burst           : 5
+    --auto_capture_delay : 2 (seconds)
+    --max_skew        : 50 (ms, largest time difference between the left and right frames of an acquired pair)
+    --replay_speed    : original (recorded frame rate) or max
     <output path>     : .
+
+--cameras uses an array of any number of cameras (camera n of the calibration profile is the nth ID) instead of the left and
+right cameras, each camera is read and corrected by its own process and writes <timestamp><suffix of the camera>.jpg
+(--record, --replay and --auto_capture are only available with the left and right cameras)
+Camera IDs can also be a video file or an image sequence (folder or glob), replayed by the file backend
+--list_cameras prints the IDs of the available cameras and exits
+--record records the raw frames of both cameras to <name>_G.podrec and <name>_D.podrec
+--replay replays a recording (<name>_G.podrec and <name>_D.podrec) instead of the cameras
+--auto_capture acquires the images once the feet stayed still for --auto_capture_delay seconds, no key press needed
+--patient records the patient of the capture in the archive of the output folder (podonator_archive.db, see PodonatorArchive.py)
+--measure writes the foot measurements (length, width, arch indexes in mm) to <image name>.json next to the images
+--stats displays the frame rate and the duration of each stage on the preview and writes a timing summary
+--detect_reference finds the calibration cardboard in the image of each camera, writes the reference points to the calibration profile
+(created if necessary) with the correction maps then exits
+--build_maps computes the correction maps and saves them in the calibration profile (created if necessary) then exits
+--check_correction compares the single pass image correction with the multi-step one for both cameras and exits
 '''
 
 if __name__ == '__main__':
     #Defines image format
     file_ext=".jpg"
-    args, output_dir = getopt.getopt(sys.argv[1:], '', ['left_camera_id=', 'right_camera_id='])
+    args, output_dir = getopt.getopt(sys.argv[1:], '', ['left_camera_id=', 'right_camera_id=', 'cameras=', 'backend=', 'profile=', 'stats', 'acquire=', 'burst=', 'auto_capture', 'auto_capture_delay=', 'max_skew=', 'measure', 'patient=', 'record=', 'replay=', 'replay_speed=', 'list_cameras', 'detect_reference', 'build_maps', 'check_correction'])
     args = dict(args)
     args.setdefault('--left_camera_id', 0)
     args.setdefault('--right_camera_id', 1)
+    profile = PodonatorLib.load_profile(args.get('--profile'))
+    if '--backend' in args:
+        PodonatorLib.capture_backend = args.get('--backend')
+    if '--acquire' in args:
+        if args.get('--acquire') not in PodonatorLib.acquire_modes:
+            sys.exit("ERROR : Unknown acquisition mode, use " + ", ".join(PodonatorLib.acquire_modes))
+        PodonatorLib.acquire_mode = args.get('--acquire')
+    if '--burst' in args:
+        PodonatorLib.burst_size = int(args.get('--burst'))
+    if '--auto_capture' in args:
+        PodonatorLib.auto_capture = True
+    if '--auto_capture_delay' in args:
+        PodonatorLib.auto_capture_delay = float(args.get('--auto_capture_delay'))
+    if '--max_skew' in args:
+        PodonatorLib.max_skew = float(args.get('--max_skew')) / 1000
+    if '--measure' in args:
+        PodonatorLib.measure_outputs = True
+    if '--patient' in args:
+        PodonatorLib.patient = args.get('--patient')
+    if '--replay_speed' in args:
+        PodonatorLib.replay_speed = args.get('--replay_speed')
+    if '--replay' in args:
+        args['--left_camera_id'] = args.get('--replay') + "_G" + PodonatorLib.recording_ext
+        args['--right_camera_id'] = args.get('--replay') + "_D" + PodonatorLib.recording_ext
+    #Recording and replay names are relative to the current folder, not to the output folder
+    for name in ('--record', '--left_camera_id', '--right_camera_id'):
+        if name in args and not str(args[name]).isdigit():
+            args[name] = os.path.abspath(args[name])
+    left_camera_id = PodonatorLib.camera_id_value(args.get('--left_camera_id'))
+    right_camera_id = PodonatorLib.camera_id_value(args.get('--right_camera_id'))
+    camera_ids = None
+    if '--cameras' in args:
+        for name in ('--record', '--replay', '--auto_capture'):
+            if name in args:
+                sys.exit("ERROR : " + name + " is not available with --cameras")
+        camera_ids = [PodonatorLib.camera_id_value(camera_id if camera_id.isdigit() else os.path.abspath(camera_id))
+                      for camera_id in args.get('--cameras').split(',')]
+        if len(camera_ids) != profile.camera_count:
+            print("WARNING : %d camera IDs given for a station of %d cameras (camera_count of the calibration profile)" % (len(camera_ids), profile.camera_count))
+    if '--list_cameras' in args:
+        print("Available cameras :", PodonatorLib.camera_pool().probe())
+        PodonatorLib.camera_pool().release()
+        sys.exit()
+    if '--detect_reference' in args:
+        PodonatorLib.camera_pool().probe([left_camera_id, right_camera_id])
+        for camera, camera_id, K, d, model in ((1, left_camera_id, profile.K1, profile.d1, profile.model1),
+                                               (2, right_camera_id, profile.K2, profile.d2, profile.model2)):
+            cam = PodonatorLib.camera_pool().get(camera_id)
+            if cam is None:
+                sys.exit("ERROR : No input from camera " + str(camera_id) + ", check camera ID")
+            check_image = "reference_cam" + str(camera) + ".jpg"
+            reference = PodonatorLib.detect_reference(cam, K, d, model, check_image)
+            if reference is None:
+                sys.exit("ERROR : Calibration cardboard not found by camera " + str(camera_id) + ", see " + check_image)
+            setattr(profile, "reference_cam" + str(camera), reference)
+            print("reference_cam" + str(camera) + " =", reference.astype(float).round(1).tolist(), "(check " + check_image + ")")
+        PodonatorLib.camera_pool().release()
+        #Maps of the previous reference points are no longer used
+        profile.clear_maps()
+        if profile.path is None:
+            profile.path = str(PodonatorLib.calibration_dir().joinpath(PodonatorLib.profile_name))
+        PodonatorLib.build_maps()
+        print("Reference points and correction maps saved to", profile.path)
+        sys.exit()
+    if '--build_maps' in args:
+        if profile.path is None:
+            profile.path = str(PodonatorLib.calibration_dir().joinpath(PodonatorLib.profile_name))
+        PodonatorLib.build_maps()
+        print("Correction maps saved to", profile.path)
+        sys.exit()
+    if '--check_correction' in args:
+        rotate_code1, rotate_code2 = PodonatorLib.rotation_codes(profile.rotate)
+        try:
+            error1 = PodonatorLib.check_correction_maps(profile.K1, profile.d1, profile.reference_cam1, PodonatorLib.frame_size, rotate_code1, model=profile.model1)
+            error2 = PodonatorLib.check_correction_maps(profile.K2, profile.d2, profile.reference_cam2, PodonatorLib.frame_size, rotate_code2, model=profile.model2)
+        except ValueError as error:
+            sys.exit("ERROR : " + str(error))
+        print("Image correction OK, max deviation %.3f pixels (left) and %.3f pixels (right)" % (error1, error2))
+        sys.exit()
     if not output_dir:
         output_dir = str(Path().absolute())
     else:
         output_dir=output_dir[0]
         Path(output_dir).mkdir(exist_ok=True)
         os.chdir(str(Path(output_dir)))
-    left_camera_id = int(args.get('--left_camera_id'))
-    right_camera_id = int(args.get('--right_camera_id'))
-    if not PodonatorLib.test_camera(left_camera_id):
+    if camera_ids is not None:
+        #The cameras are opened by the worker processes of the array
+        PodonatorLib.podonator_array(output_dir, camera_ids, '--stats' in args)
+        sys.exit()
+    #Open both cameras in parallel, they are kept open for the capture
+    available = PodonatorLib.camera_pool().probe([left_camera_id, right_camera_id])
+    if left_camera_id not in available:
         print("ERROR: No input from left camera, check camera ID")
-    if not PodonatorLib.test_camera(right_camera_id):
+    if right_camera_id not in available:
         print("ERROR: No input from right camera, check camera ID")
-    if PodonatorLib.test_camera(left_camera_id) and PodonatorLib.test_camera(right_camera_id):
-        PodonatorLib.podonator(output_dir, left_camera_id, right_camera_id)
+    if left_camera_id in available and right_camera_id in available:
+        PodonatorLib.podonator(output_dir, left_camera_id, right_camera_id, '--stats' in args, args.get('--record'))
         print("Images acquired and transformed written to ",output_dir)
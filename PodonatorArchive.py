@@ -0,0 +1,260 @@
+import sys
+import getopt
+import glob
+import json
+import sqlite3
+import datetime
+import threading
+from pathlib import Path
+import numpy as np
+import cv2 as cv
+import PodonatorLib
+
+
+'''
+usage:
+    PodonatorArchive.py [--patient] [--station] [--since <YYYY-MM-DD>] [--until <YYYY-MM-DD>] [--limit] [--index] [<output folder>]
+
+default values:
+    --limit       : 50
+    <output folder> : .
+
+Lists the captures of the archive of an output folder (podonator_archive.db), newest first, with their images and foot
+measurements. --index first adds the images of the folder which are not archived yet (images written by an older version).
+'''
+
+# Archive file name, in the output folder next to the images
+archive_name = "podonator_archive.db"
+# Long side of the thumbnails (pixels) and their JPEG quality
+thumbnail_size = 256
+thumbnail_quality = 80
+# Time format of the capture names
+name_format = "%Y-%m-%d-%H%M%S"
+
+# Thumbnails are kept in their own table so listing the captures never reads them
+schema = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    timestamp REAL NOT NULL,
+    station TEXT,
+    calibration_version TEXT,
+    patient TEXT
+);
+CREATE INDEX IF NOT EXISTS captures_timestamp ON captures (timestamp);
+CREATE INDEX IF NOT EXISTS captures_patient ON captures (patient, timestamp);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    capture_id INTEGER NOT NULL REFERENCES captures (id) ON DELETE CASCADE,
+    camera TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    length_mm REAL,
+    width_mm REAL,
+    measures TEXT
+);
+CREATE INDEX IF NOT EXISTS images_capture ON images (capture_id);
+CREATE TABLE IF NOT EXISTS thumbnails (
+    image_id INTEGER PRIMARY KEY REFERENCES images (id) ON DELETE CASCADE,
+    data BLOB NOT NULL
+);
+"""
+
+def make_thumbnail(img):
+    """Returns the JPEG encoded thumbnail of an image (long side thumbnail_size pixels)"""
+    scale = min(1.0, thumbnail_size / max(img.shape[:2]))
+    small = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    return cv.imencode(".jpg", small, [cv.IMWRITE_JPEG_QUALITY, thumbnail_quality])[1].tobytes()
+
+def capture_time(name, path=None):
+    """Returns the capture time of a capture name (time of the capture), the modification time of path otherwise"""
+    try:
+        return datetime.datetime.strptime(name, name_format).timestamp()
+    except ValueError:
+        return Path(path).stat().st_mtime if path is not None else datetime.datetime.now().timestamp()
+
+def is_capture_name(name):
+    """Returns True if name is a capture time (name_format)"""
+    try:
+        datetime.datetime.strptime(name, name_format)
+    except ValueError:
+        return False
+    return True
+
+def camera_suffixes():
+    """Returns the output file suffixes of the cameras of the station (left and right cameras by default)"""
+    station = PodonatorLib.profile()
+    return set(PodonatorLib.default_suffixes.values()) | {station.camera(index).suffix for index in range(1, station.camera_count + 1)}
+
+class Archive:
+    """Index of the captures of an output folder : capture time, station, calibration version, patient, image files,
+    foot measurements and thumbnails in an SQLite database next to the images
+    A single archive can be used by several threads, several processes can write to the same archive"""
+    def __init__(self, folder):
+        self.folder = Path(folder).absolute()
+        self.path = self.folder.joinpath(archive_name)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), timeout=30.0, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        #Readers (the GUI) are not blocked by a capture being written
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        with self.lock, self.connection:
+            self.connection.executescript(schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the database"""
+        self.connection.close()
+
+    def add_capture(self, name, images, timestamp=None, station=None, calibration_version=None, patient=None):
+        """Adds a capture (replacing a previous capture of the same name)
+        images is a list of (camera suffix, image path, JPEG thumbnail, foot measurements or None)
+        Returns the capture ID"""
+        if timestamp is None:
+            timestamp = capture_time(name)
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM captures WHERE name = ?", (name,))
+            capture_id = self.connection.execute(
+                "INSERT INTO captures (name, timestamp, station, calibration_version, patient) VALUES (?, ?, ?, ?, ?)",
+                (name, timestamp, station, calibration_version, patient or None)).lastrowid
+            self.insert_images(capture_id, images)
+        return capture_id
+
+    def add_images(self, name, images, timestamp=None):
+        """Adds images to a capture, keeping its other images, patient and station (the capture is created if it is not
+        archived yet), images is a list of (camera suffix, image path, JPEG thumbnail, foot measurements or None)
+        Returns the capture ID"""
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT id FROM captures WHERE name = ?", (name,)).fetchone()
+            if row is not None:
+                self.insert_images(row[0], images)
+                return row[0]
+        return self.add_capture(name, images, timestamp)
+
+    def insert_images(self, capture_id, images):
+        """Inserts the images of a capture, replacing the images of the same paths (the lock and a transaction must be held)"""
+        for camera, path, thumbnail, measures in images:
+            path = Path(path).absolute()
+            path = str(path.relative_to(self.folder)) if path.parent == self.folder else str(path)
+            self.connection.execute("DELETE FROM images WHERE path = ?", (path,))
+            image_id = self.connection.execute(
+                "INSERT INTO images (capture_id, camera, path, length_mm, width_mm, measures) VALUES (?, ?, ?, ?, ?, ?)",
+                (capture_id, camera, path, measures["length_mm"] if measures else None, measures["width_mm"] if measures else None,
+                 json.dumps(measures) if measures else None)).lastrowid
+            self.connection.execute("INSERT INTO thumbnails (image_id, data) VALUES (?, ?)", (image_id, sqlite3.Binary(thumbnail)))
+
+    def query(self, patient=None, station=None, since=None, until=None, limit=50, offset=0):
+        """Returns the captures matching all the given criteria (patient, station, capture time between the since and until
+        timestamps), newest first, as dictionaries with the list of their images (without thumbnails)"""
+        conditions, values = [], []
+        for condition, value in (("patient = ?", patient), ("station = ?", station), ("timestamp >= ?", since), ("timestamp < ?", until)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        with self.lock:
+            captures = [dict(row) for row in self.connection.execute(
+                "SELECT * FROM captures" + where + " ORDER BY timestamp DESC LIMIT ? OFFSET ?", values + [limit, offset])]
+            for capture in captures:
+                capture["images"] = []
+                for row in self.connection.execute(
+                        "SELECT id, camera, path, length_mm, width_mm FROM images WHERE capture_id = ? ORDER BY id", (capture["id"],)):
+                    image = dict(row)
+                    image["path"] = str(self.folder.joinpath(image["path"]))
+                    capture["images"].append(image)
+        return captures
+
+    def patients(self):
+        """Returns the patients of the archive with their number of captures and last capture time"""
+        with self.lock:
+            return [tuple(row) for row in self.connection.execute(
+                "SELECT patient, COUNT(*), MAX(timestamp) FROM captures WHERE patient IS NOT NULL GROUP BY patient ORDER BY patient")]
+
+    def thumbnail(self, image_id):
+        """Returns the JPEG thumbnail of an image (bytes), None if the image is not archived"""
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM thumbnails WHERE image_id = ?", (image_id,)).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def thumbnail_image(self, image_id):
+        """Returns the decoded thumbnail of an image, None if the image is not archived"""
+        data = self.thumbnail(image_id)
+        return cv.imdecode(np.frombuffer(data, np.uint8), cv.IMREAD_COLOR) if data is not None else None
+
+    def measures(self, image_id):
+        """Returns the foot measurements of an image, None if it was not measured"""
+        with self.lock:
+            row = self.connection.execute("SELECT measures FROM images WHERE id = ?", (image_id,)).fetchone()
+        return json.loads(row[0]) if row is not None and row[0] else None
+
+    def index_folder(self):
+        """Adds the images of the folder which are not archived yet, named <capture name><camera suffix>, to their capture
+        (an archived capture keeps its images, patient and station)
+        Other images (reference_cam1.jpg...) are ignored : the suffix must be a camera suffix of the station or the capture
+        name a capture time
+        Measurements written next to the images are archived too
+        Returns the number of captures added or completed"""
+        with self.lock:
+            archived = {row[0] for row in self.connection.execute("SELECT path FROM images")}
+        suffixes = camera_suffixes()
+        captures = {}
+        for path in sorted(glob.glob(str(self.folder.joinpath("*")))):
+            path = Path(path)
+            if path.suffix.lower() not in PodonatorLib.image_extensions or path.name in archived or "_" not in path.stem:
+                continue
+            name, camera = path.stem.rsplit("_", 1)
+            if "_" + camera not in suffixes and not is_capture_name(name):
+                continue
+            captures.setdefault(name, []).append(("_" + camera, path))
+        for name, paths in captures.items():
+            images = []
+            for camera, path in paths:
+                #JPEG images are decoded at a quarter of their size, enough for a thumbnail
+                img = cv.imread(str(path), cv.IMREAD_REDUCED_COLOR_4)
+                if img is None:
+                    continue
+                try:
+                    measures = json.loads(path.with_suffix(".json").read_text()).get("foot")
+                except (OSError, ValueError):
+                    measures = None
+                images.append((camera, path, make_thumbnail(img), measures))
+            if images:
+                self.add_images(name, images, capture_time(name, paths[0][1]))
+        return len(captures)
+
+def archive_capture(naming_pattern, images, patient=None):
+    """Adds a capture written by Podonator to the archive of its folder
+    images is a list of (camera suffix, image path, corrected image or JPEG thumbnail, foot measurements or None)"""
+    folder, name = Path(naming_pattern).absolute().parent, Path(naming_pattern).name
+    images = [(camera, path, img if isinstance(img, bytes) else make_thumbnail(img), measures) for camera, path, img, measures in images]
+    with Archive(folder) as archive:
+        return archive.add_capture(name, images, station=PodonatorLib.profile().station,
+                                   calibration_version=PodonatorLib.calibration_version(), patient=patient)
+
+def day_timestamp(day):
+    """Returns the timestamp of the start of a day (YYYY-MM-DD)"""
+    return datetime.datetime.strptime(day, "%Y-%m-%d").timestamp()
+
+if __name__ == '__main__':
+    args, folder = getopt.getopt(sys.argv[1:], '', ['patient=', 'station=', 'since=', 'until=', 'limit=', 'index'])
+    args = dict(args)
+    folder = folder[0] if folder else "."
+    if not Path(folder).is_dir():
+        sys.exit("usage: PodonatorArchive.py [--patient] [--station] [--since <YYYY-MM-DD>] [--until <YYYY-MM-DD>] [--limit] [--index] [<output folder>]")
+    with Archive(folder) as archive:
+        if '--index' in args:
+            print("%d captures added or completed in %s" % (archive.index_folder(), archive.path))
+        since = day_timestamp(args['--since']) if '--since' in args else None
+        until = day_timestamp(args['--until']) + 86400 if '--until' in args else None
+        for capture in archive.query(args.get('--patient'), args.get('--station'), since, until, int(args.get('--limit', 50))):
+            print("%s  station %s  patient %s  calibration %s" % (datetime.datetime.fromtimestamp(capture["timestamp"]).strftime("%Y-%m-%d %H:%M:%S"),
+                                                                   capture["station"], capture["patient"] or "-", capture["calibration_version"]))
+            for image in capture["images"]:
+                measures = "" if image["length_mm"] is None else "  length %.1f mm, width %.1f mm" % (image["length_mm"], image["width_mm"])
+                print("    %s%s" % (image["path"], measures))
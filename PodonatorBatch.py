@@ -0,0 +1,129 @@
+import sys
+import getopt
+import glob
+import json
+import time
+import multiprocessing
+from pathlib import Path
+import cv2 as cv
+import PodonatorLib
+
+
+'''
+usage:
+    PodonatorBatch.py [--output] [--processes] [--profile] [--force] <raw images folder or glob>
+
+default values:
+    --output    : <raw images folder>/corrected
+    --processes : number of CPU cores
+    --profile   : PODONATOR_PROFILE environment variable or podonator_profile.npz next to PodonatorLib.py
+
+Raw images are the uncorrected camera frames, named <name>_G.<ext> (left camera) and <name>_D.<ext> (right camera).
+Corrected images are written to the output folder as <name>_G.jpg and <name>_D.jpg, pairs which are already
+corrected with the current calibration are skipped unless --force is used.
+'''
+
+# Lists the pairs already processed, with the calibration version and raw images used
+manifest_name = "podonator_batch.json"
+
+def find_pairs(pattern):
+    """Returns a dictionary {name: (left image path, right image path)} of the raw image pairs matching a folder or a glob"""
+    if Path(pattern).is_dir():
+        pattern = str(Path(pattern).joinpath("*"))
+    pairs = {}
+    for left in sorted(glob.glob(pattern)):
+        left = Path(left)
+        if not left.stem.endswith("_G"):
+            continue
+        right = left.with_name(left.stem[:-2] + "_D" + left.suffix)
+        if right.exists():
+            pairs[left.stem[:-2]] = (left, right)
+    return pairs
+
+def input_stamp(paths):
+    """Returns the modification times of the raw images, used to detect updated inputs"""
+    return [path.stat().st_mtime_ns for path in paths]
+
+def correct_pair(job):
+    """Worker : corrects a raw image pair and writes the output images
+    Returns the name of the pair, the number of pixels processed and the error message (None if the pair is corrected),
+    a failed pair does not stop the other pairs"""
+    name, (left, right), output_dir = job
+    try:
+        img1 = cv.imread(str(left))
+        img2 = cv.imread(str(right))
+        if img1 is None or img2 is None:
+            return name, 0, "Unable to read raw images"
+        cal = PodonatorLib.profile()
+        if cal.mirror:
+            img1 = cv.flip(img1, 1)
+            img2 = cv.flip(img2, 1)
+        correct_img1, correct_img2 = PodonatorLib.acquire_images(img1, img2, cal.rotate)
+        for future in PodonatorLib.output_images(correct_img1, correct_img2, str(Path(output_dir).joinpath(name)), PodonatorLib.file_ext, cal.image_dpi):
+            future.result()
+    except Exception as error: # pylint: disable=broad-except
+        return name, 0, str(error) or type(error).__name__
+    return name, img1.shape[0] * img1.shape[1] + img2.shape[0] * img2.shape[1], None
+
+def batch(pattern, output_dir, processes=None, force=False, profile_path=None):
+    """Corrects all raw image pairs matching pattern with a process pool, skipping pairs already up to date"""
+    PodonatorLib.load_profile(profile_path)
+    pairs = find_pairs(pattern)
+    if not pairs:
+        print("No raw image pairs found in", pattern)
+        return
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    manifest_file = Path(output_dir).joinpath(manifest_name)
+    try:
+        manifest = json.loads(manifest_file.read_text())
+    except (OSError, ValueError):
+        manifest = {}
+    version = PodonatorLib.calibration_version()
+    jobs = []
+    for name, paths in pairs.items():
+        outputs = [Path(output_dir).joinpath(name + suffix + PodonatorLib.file_ext) for suffix in ("_G", "_D")]
+        done = manifest.get(name, {})
+        if not force and done.get("calibration") == version and done.get("inputs") == input_stamp(paths) and all(path.exists() for path in outputs):
+            continue
+        jobs.append((name, paths, output_dir))
+    print("%d pairs found, %d up to date, %d to process" % (len(pairs), len(pairs) - len(jobs), len(jobs)))
+    if not jobs:
+        return
+    #Build (or load) the correction maps once before the workers load them from disk
+    first = cv.imread(str(jobs[0][1][0]))
+    if first is not None:
+        PodonatorLib.acquire_images(first, first, PodonatorLib.profile().rotate)
+    start = time.perf_counter()
+    pixels = 0
+    failed = 0
+    #The pairs corrected so far are recorded even if the run is interrupted
+    try:
+        with multiprocessing.Pool(processes, PodonatorLib.load_profile, (profile_path,)) as pool:
+            for count, (name, pair_pixels, error) in enumerate(pool.imap_unordered(correct_pair, jobs), 1):
+                if error is not None:
+                    print("ERROR : %s : %s" % (name, error))
+                    #Corrected again by the next run
+                    manifest.pop(name, None)
+                    failed += 1
+                    continue
+                pixels += pair_pixels
+                manifest[name] = {"calibration": version, "inputs": input_stamp(pairs[name])}
+                elapsed = time.perf_counter() - start
+                print("[%d/%d] %s (%.2f pairs/s)" % (count, len(jobs), name, count / elapsed))
+    finally:
+        manifest_file.write_text(json.dumps(manifest, indent=1))
+    elapsed = time.perf_counter() - start
+    print("Processed %d pairs in %.1f s : %.2f pairs/s, %.1f Mpixels/s" % (len(jobs), elapsed, len(jobs) / elapsed, pixels / elapsed / 1e6))
+    if failed:
+        print("%d pairs failed" % failed)
+
+if __name__ == '__main__':
+    args, pattern = getopt.getopt(sys.argv[1:], '', ['output=', 'processes=', 'profile=', 'force'])
+    args = dict(args)
+    if not pattern:
+        sys.exit("usage: PodonatorBatch.py [--output] [--processes] [--profile] [--force] <raw images folder or glob>")
+    pattern = pattern[0]
+    input_dir = Path(pattern) if Path(pattern).is_dir() else Path(pattern).parent
+    output_dir = args.get('--output', str(input_dir.joinpath("corrected")))
+    processes = int(args['--processes']) if '--processes' in args else None
+    batch(pattern, output_dir, processes, '--force' in args, args.get('--profile'))
@@ -0,0 +1,193 @@
+import sys
+import os
+import getopt
+import glob
+import json
+import time
+import shlex
+import subprocess
+import tempfile
+import platform
+from pathlib import Path
+import numpy as np
+import cv2 as cv
+import PodonatorLib
+
+
+'''
+usage:
+    PodonatorBench.py [--iterations] [--frames <image glob>] [--stages <stage,stage...>] [--baseline <file>]
+                      [--save_baseline] [--tolerance] [--profile]
+    PodonatorBench.py --startup [--iterations] [--gui_command <command>] [--baseline <file>] [--save_baseline] [--tolerance]
+
+default values:
+    --iterations : 50 (5 launches of the GUI with --startup)
+    --frames     : synthetic 1920x1080 frames (or an image glob or a .podrec recording of a camera)
+    --stages     : all stages
+    --baseline   : bench_baseline.json next to PodonatorBench.py
+    --tolerance  : 0.2 (a stage is reported as a regression if its median latency is 20% above the baseline)
+    --gui_command : python PodonatorGUI.py (use the packaged executable to measure its startup)
+
+Measures the latency of each stage of the correction pipeline without cameras, using the file capture backend
+(PodonatorLib.FileCamera) as a stand-in for cv.VideoCapture. Exits with an error if a stage is slower than the stored baseline.
+--startup measures the startup of the GUI instead : time from the launch to the main window, to the loaded image correction
+modules and to the first preview frame (synthetic frames replayed by the file capture backend).
+'''
+
+# Number of launches of the GUI measured by --startup
+startup_runs = 5
+
+def synthetic_frames(count=4, size=PodonatorLib.frame_size):
+    """Returns synthetic frames (gradient, checkerboard and noise) with a content close to a camera image"""
+    w, h = size
+    rng = np.random.default_rng(0)
+    x, y = np.meshgrid(np.arange(w), np.arange(h))
+    base = (x * 255 // w).astype(np.uint8)
+    board = (((x // 60) + (y // 60)) % 2 * 60).astype(np.uint8)
+    frames = []
+    for i in range(count):
+        frame = np.dstack((base, (y * 255 // h).astype(np.uint8), board + i * 20))
+        noise = rng.integers(0, 16, frame.shape, dtype=np.uint8)
+        frames.append(cv.add(frame, noise))
+    return frames
+
+def load_frames(pattern):
+    """Returns the recorded frames matching pattern (image files or a raw frame recording)"""
+    if pattern.lower().endswith(PodonatorLib.recording_ext):
+        frames = list(PodonatorLib.read_recording(pattern)["frame"])
+    else:
+        frames = [cv.imread(fn) for fn in sorted(glob.glob(pattern))]
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        sys.exit("ERROR : No frames found matching " + pattern)
+    return frames
+
+def measure(function, iterations):
+    """Runs function once to warm up (correction maps...) then iterations times
+    Returns the latencies in seconds"""
+    function()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def stages(frames, output_dir):
+    """Returns the benchmarked stages as {name: function}, each function processing one frame (or pair)"""
+    cal = PodonatorLib.profile()
+    rotate_code1, _ = PodonatorLib.rotation_codes(cal.rotate)
+    frame = frames[0]
+    u_frame = PodonatorLib.undistort_image(frame, cal.K1, cal.d1, cal.model1)
+    up1, up2 = PodonatorLib.acquire_images(frames[0], frames[-1], cal.rotate)
+
+    def preview():
+        img = PodonatorLib.preview_image(frames[0], frames[-1], cal.rotate)
+        return cv.cvtColor(img, cv.COLOR_BGR2RGB)
+
+    def capture_to_disk():
+        cam1 = PodonatorLib.FileCamera(frames, fps=0)
+        cam2 = PodonatorLib.FileCamera(frames[::-1], fps=0)
+        stereo = PodonatorLib.StereoGrabber(cam1, cam2, cal.mirror)
+        stereo.start()
+        _, img1, _, img2 = stereo.latest()
+        stereo.stop()
+        img1, img2 = PodonatorLib.acquire_images(img1, img2, cal.rotate)
+        PodonatorLib.output_images(img1, img2, str(Path(output_dir).joinpath("bench")), PodonatorLib.file_ext, cal.image_dpi)
+
+    return {
+        "undistort_image": lambda: PodonatorLib.undistort_image(frame, cal.K1, cal.d1, cal.model1),
+        "perpective_correction": lambda: PodonatorLib.perpective_correction(u_frame, cal.reference_cam1),
+        "correct_image": lambda: PodonatorLib.correct_image(frame, cal.K1, cal.d1, cal.reference_cam1, rotate_code1, model=cal.model1),
+        "sharpness": lambda: PodonatorLib.sharpness(frame),
+        "preview": preview,
+        "output_images": lambda: PodonatorLib.output_images(up1, up2, str(Path(output_dir).joinpath("bench")), PodonatorLib.file_ext, cal.image_dpi),
+        "capture_to_disk": capture_to_disk,
+    }
+
+def startup(command, runs):
+    """Launches the GUI runs times on synthetic frames with --startup_timing
+    Returns the latencies (seconds) from the launch to the main window, to the loaded modules and to the first preview frame"""
+    latencies = {"startup_window": [], "startup_modules": [], "startup_first_frame": []}
+    with tempfile.TemporaryDirectory() as folder:
+        #Different image sequences so the GUI opens two cameras
+        frames = synthetic_frames()
+        for i, frame in enumerate(frames):
+            cv.imwrite(str(Path(folder).joinpath("left%d.jpg" % i)), frame)
+            cv.imwrite(str(Path(folder).joinpath("right%d.jpg" % i)), frames[-1 - i])
+        timing_file = Path(folder).joinpath("startup.json")
+        env = dict(os.environ, PODONATOR_CAPTURE_BACKEND="file")
+        for _ in range(runs):
+            start = time.time()
+            subprocess.run(command + ["--left_camera_id", str(Path(folder).joinpath("left*.jpg")), "--right_camera_id",
+                                      str(Path(folder).joinpath("right*.jpg")), "--startup_timing", str(timing_file)],
+                           env=env, cwd=folder, check=True, timeout=120)
+            times = json.loads(timing_file.read_text())
+            for name in latencies:
+                latencies[name].append(times[name[len("startup_"):]] - start)
+    return latencies
+
+def summary(latencies):
+    """Returns the latency percentiles (ms) and the frame rate of a stage"""
+    ms = np.array(latencies) * 1000
+    return {"p50": float(np.percentile(ms, 50)), "p90": float(np.percentile(ms, 90)), "p99": float(np.percentile(ms, 99)),
+            "fps": float(1000 / ms.mean())}
+
+def compare(results, baseline, tolerance):
+    """Prints the results next to the baseline
+    Returns the names of the stages slower than the baseline by more than tolerance"""
+    regressions = []
+    print("%-22s %9s %9s %9s %8s %10s" % ("stage", "p50 (ms)", "p90 (ms)", "p99 (ms)", "fps", "baseline"))
+    for name, result in results.items():
+        reference = baseline.get(name)
+        status = ""
+        if reference:
+            ratio = result["p50"] / reference["p50"]
+            status = "%+.0f%%" % ((ratio - 1) * 100)
+            if ratio > 1 + tolerance:
+                status += " SLOWER"
+                regressions.append(name)
+        print("%-22s %9.2f %9.2f %9.2f %8.1f %10s" % (name, result["p50"], result["p90"], result["p99"], result["fps"], status))
+    return regressions
+
+def main():
+    args, _ = getopt.getopt(sys.argv[1:], '', ['iterations=', 'frames=', 'stages=', 'baseline=', 'save_baseline', 'tolerance=', 'profile=',
+                                               'startup', 'gui_command='])
+    args = dict(args)
+    args.setdefault('--iterations', startup_runs if '--startup' in args else 50)
+    args.setdefault('--baseline', str(Path(__file__).parent.joinpath("bench_baseline.json")))
+    args.setdefault('--tolerance', 0.2)
+    iterations = int(args.get('--iterations'))
+    PodonatorLib.load_profile(args.get('--profile'))
+    frames = load_frames(args['--frames']) if '--frames' in args else synthetic_frames()
+    results = {}
+    if '--startup' in args:
+        command = shlex.split(args['--gui_command']) if '--gui_command' in args else [sys.executable, str(Path(__file__).parent.joinpath("PodonatorGUI.py"))]
+        for name, latencies in startup(command, iterations).items():
+            results[name] = summary(latencies)
+    else:
+        with tempfile.TemporaryDirectory() as output_dir:
+            all_stages = stages(frames, output_dir)
+            names = args['--stages'].split(',') if '--stages' in args else list(all_stages)
+            for name in names:
+                if name not in all_stages:
+                    sys.exit("ERROR : Unknown stage " + name + ", available stages : " + ", ".join(all_stages))
+                results[name] = summary(measure(all_stages[name], iterations))
+    baseline_file = Path(args.get('--baseline'))
+    try:
+        baseline = json.loads(baseline_file.read_text())
+    except (OSError, ValueError):
+        baseline = {}
+    print("%d iterations on %dx%d frames (%s, OpenCV %s)" % (iterations, frames[0].shape[1], frames[0].shape[0], platform.processor() or platform.machine(), cv.__version__))
+    regressions = compare(results, baseline.get("stages", {}), float(args.get('--tolerance')))
+    if '--save_baseline' in args:
+        baseline.setdefault("stages", {}).update(results)
+        baseline["machine"] = platform.node()
+        baseline["opencv"] = cv.__version__
+        baseline_file.write_text(json.dumps(baseline, indent=1))
+        print("Baseline saved to", baseline_file)
+    elif regressions:
+        sys.exit("ERROR : Slower than baseline : " + ", ".join(regressions))
+
+if __name__ == '__main__':
+    main()
@@ -2,23 +2,58 @@
 import sys
 import datetime
 import os
-import webbrowser
+import getopt
+import json
+import threading
+import time
+import contextlib
 from pathlib import Path
-from PyQt5.QtWidgets import (QWidget, QLabel, QLineEdit, QSpinBox,\
+from PyQt5.QtWidgets import (QWidget, QLabel, QLineEdit, QComboBox,\
     QPushButton, QGridLayout, QApplication, QFileDialog, QMessageBox,\
-    QVBoxLayout)
+    QVBoxLayout, QCheckBox, QListWidget, QListWidgetItem, QListView)
 from PyQt5 import QtCore
 from PyQt5 import QtGui
-from PyQt5.Qt import Qt
-import numpy as np
-import cv2 as cv
-import PodonatorLib
+from PyQt5.QtCore import Qt
+
+'''
+usage:
+    PodonatorGUI.py [--left_camera_id --right_camera_id] [--startup_timing <file>]
+
+Camera IDs given on the command line (camera index, video file or image sequence) are used instead of looking for the cameras
+--startup_timing opens the preview once started, closes it after the first frame and writes the times (time.time()) at which
+the main window was shown, the image correction modules were loaded and the first preview frame was shown to a JSON file
+'''
+
+# OpenCV and the image correction library are imported by moduleLoader once the main window is shown
+cv = None
+PodonatorLib = None
+# Startup times of --startup_timing (None otherwise)
+startupTimes = None
+
+class moduleLoader(QtCore.QThread):
+    """Imports OpenCV, numpy and the image correction library in the background so the main window is shown first"""
+    loaded = QtCore.pyqtSignal()
+
+    def run(self):
+        global cv, PodonatorLib # pylint: disable=global-statement
+        import cv2 as cv
+        import PodonatorLib
+        self.loaded.emit()
+
+class cameraProbe(QtCore.QThread):
+    """Looks for the available cameras in the background (the cameras found are kept open by the camera pool until
+    the selected cameras are known)"""
+    found = QtCore.pyqtSignal(list)
+
+    def run(self):
+        self.found.emit(PodonatorLib.camera_pool().probe())
 
 class podonatorWidget(QWidget):
-    """Main window widget"""
-    def __init__(self):
+    """Main window widget, the settings depending on the image correction library are filled once it is loaded
+    cameraIDs are the camera IDs shown without looking for the cameras (None to look for them)"""
+    def __init__(self, cameraIDs=None):
         super().__init__()
-        self.test_camera_flag = False
+        self.cameraIDs = cameraIDs
         pathEditLabel = QLabel("Output Path")
         pathEditLabel.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
         self.outputFolder = str(Path().absolute())
@@ -26,13 +61,25 @@ class podonatorWidget(QWidget):
         pathEditButton = QPushButton("Browse...")
         camLIDLabel = QLabel("Left Camera ID")
         camLIDLabel.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
-        self.camLID = QSpinBox(self)
-        self.camLID.setValue(0)
+        self.camLID = QComboBox(self)
         camRIDLabel = QLabel("Right Camera ID")
         camRIDLabel.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
-        self.camRID = QSpinBox(self)
-        self.camRID.setValue(1)
-        previewButton = QPushButton("Preview")
+        self.camRID = QComboBox(self)
+        self.refreshButton = QPushButton("Loading...")
+        self.refreshButton.setEnabled(False)
+        self.statsBox = QCheckBox("Show timing statistics")
+        self.autoBox = QCheckBox("Acquire automatically when the feet are still")
+        self.measureBox = QCheckBox("Measure the feet")
+        acquireLabel = QLabel("Acquisition")
+        acquireLabel.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+        self.acquireMode = QComboBox(self)
+        patientLabel = QLabel("Patient")
+        patientLabel.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+        self.patientEdit = QLineEdit()
+        self.archiveButton = QPushButton("Archive...")
+        self.archiveButton.setEnabled(False)
+        self.previewButton = QPushButton("Preview")
+        self.previewButton.setEnabled(False)
         layout = QGridLayout()
         layout.setSpacing(10)
         layout.addWidget(pathEditLabel, 1, 0)
@@ -42,39 +89,184 @@ class podonatorWidget(QWidget):
         layout.addWidget(self.camLID, 2, 1)
         layout.addWidget(camRIDLabel, 2, 2)
         layout.addWidget(self.camRID, 2, 3)
-        layout.addWidget(previewButton, 3, 0, 1, 4)
+        layout.addWidget(self.refreshButton, 3, 0)
+        layout.addWidget(self.statsBox, 3, 1)
+        layout.addWidget(acquireLabel, 3, 2)
+        layout.addWidget(self.acquireMode, 3, 3)
+        layout.addWidget(self.autoBox, 4, 1, 1, 3)
+        layout.addWidget(self.measureBox, 5, 1, 1, 3)
+        layout.addWidget(patientLabel, 6, 0)
+        layout.addWidget(self.patientEdit, 6, 1, 1, 2)
+        layout.addWidget(self.archiveButton, 6, 3)
+        layout.addWidget(self.previewButton, 7, 0, 1, 4)
         self.setLayout(layout)
-        previewButton.clicked.connect(self.previewAction)
+        self.previewButton.clicked.connect(self.previewAction)
         pathEditButton.clicked.connect(self.browseAction)
+        self.refreshButton.clicked.connect(self.refreshAction)
+        self.archiveButton.clicked.connect(self.archiveAction)
+        self.archiveWindow = None
         self.critical = QMessageBox()
         self.critical.setIcon(QMessageBox.Critical)
         self.critical.setWindowTitle("Error")
         self.critical.setWindowIcon(getIcon())
+        self.probe = cameraProbe()
+        self.probe.found.connect(self.setCameras)
+
+    def modulesLoaded(self):
+        """Fills the settings from the image correction library defaults then looks for the cameras"""
+        self.autoBox.setChecked(PodonatorLib.auto_capture)
+        self.measureBox.setChecked(PodonatorLib.measure_outputs)
+        self.acquireMode.addItems(["Single frame", "Median of %d frames" % PodonatorLib.burst_size, "Mean of %d frames" % PodonatorLib.burst_size, "Sharpest frame"])
+        self.acquireMode.setCurrentIndex(PodonatorLib.acquire_modes.index(PodonatorLib.acquire_mode))
+        self.previewButton.setEnabled(True)
+        self.archiveButton.setEnabled(True)
+        if self.cameraIDs is not None:
+            self.setCameras(self.cameraIDs)
+        else:
+            self.refreshAction()
+
+    def refreshAction(self):
+        """Looks for the available cameras in the background"""
+        if not self.probe.isRunning():
+            self.refreshButton.setEnabled(False)
+            self.refreshButton.setText("Looking for cameras...")
+            self.probe.start()
+
+    def setCameras(self, cameraIDs):
+        """Fills the camera lists with the available cameras (keeps the current selection if possible)"""
+        for comboBox, default in ((self.camLID, 0), (self.camRID, 1)):
+            current = comboBox.currentText()
+            comboBox.clear()
+            comboBox.addItems([str(cameraID) for cameraID in cameraIDs])
+            if current:
+                comboBox.setCurrentText(current)
+            elif len(cameraIDs) > default:
+                comboBox.setCurrentIndex(default)
+        #Only the selected cameras stay open, another camera is opened again when it is selected
+        PodonatorLib.camera_pool().keep([PodonatorLib.camera_id_value(comboBox.currentText()) for comboBox in (self.camLID, self.camRID)])
+        self.refreshButton.setText("Refresh cameras")
+        self.refreshButton.setEnabled(True)
 
     def previewAction(self):
         """Action to run when the Preview button is clicked"""
-        if not self.test_camera_flag:
-            if not PodonatorLib.test_camera(int(self.camLID.text())):
-                self.critical.setText("Invalid Camera ID\nNo input from left camera, check camera ID")
-                self.critical.exec_()
-            if not PodonatorLib.test_camera(int(self.camRID.text())):
-                self.critical.setText("Invalid Camera ID\nNo input from right camera, check camera ID")
-                self.critical.exec_()
-            if PodonatorLib.test_camera(int(self.camLID.text())) and PodonatorLib.test_camera(int(self.camRID.text())):
-                self.test_camera_flag = True
-        if self.test_camera_flag:
-            self.outputFolder = str(Path(self.pathEdit.text()))
-            podorun(self.outputFolder, int(self.camLID.text()), int(self.camRID.text()))
+        if not self.camLID.currentText() or not self.camRID.currentText():
+            self.critical.setText("No camera found\nCheck the cameras are connected then click on Refresh cameras")
+            self.critical.exec_()
+            return
+        leftCameraID = PodonatorLib.camera_id_value(self.camLID.currentText())
+        rightCameraID = PodonatorLib.camera_id_value(self.camRID.currentText())
+        if not PodonatorLib.test_camera(leftCameraID):
+            self.critical.setText("Invalid Camera ID\nNo input from left camera, check camera ID")
+            self.critical.exec_()
+            return
+        if not PodonatorLib.test_camera(rightCameraID):
+            self.critical.setText("Invalid Camera ID\nNo input from right camera, check camera ID")
+            self.critical.exec_()
+            return
+        self.outputFolder = str(Path(self.pathEdit.text()))
+        PodonatorLib.acquire_mode = PodonatorLib.acquire_modes[self.acquireMode.currentIndex()]
+        PodonatorLib.auto_capture = self.autoBox.isChecked()
+        PodonatorLib.measure_outputs = self.measureBox.isChecked()
+        PodonatorLib.patient = self.patientEdit.text().strip() or None
+        podorun(self.outputFolder, leftCameraID, rightCameraID, self.statsBox.isChecked())
+
+    def archiveAction(self):
+        """Opens the archive of the output folder, showing the captures of the patient if one is entered"""
+        self.archiveWindow = archiveBrowser(str(Path(self.pathEdit.text())), self.patientEdit.text().strip())
+        self.archiveWindow.show()
 
     def browseAction(self):
         """Directory browser to set the output path"""
         self.outputFolder = str(Path(QFileDialog.getExistingDirectory(self, "Output folder")))
         self.pathEdit.setText(self.outputFolder)
 
+class previewWorker(QtCore.QThread):
+    """Preview thread, corrects the latest camera frames and sends them to the preview window
+    New frames are dropped while the window is still busy displaying the previous one"""
+    frameReady = QtCore.pyqtSignal(QtGui.QImage, float) # Preview image and capture time of its frames
+    failed = QtCore.pyqtSignal(str)
+    autoAcquire = QtCore.pyqtSignal() # Feet still long enough (hands-free capture)
+
+    def __init__(self, cam1, cam2, rotate_bool, longSide, stats=None):
+        super().__init__()
+        self.stats = stats
+        self.trigger = PodonatorLib.MotionTrigger() if PodonatorLib.auto_capture else None
+        self.rotate = rotate_bool
+        self.longSide = longSide
+        self.running = True
+        self.pending = False # A frame is waiting to be displayed
+        self.img1 = None # Raw frames of the last preview image
+        self.img2 = None
+        #Read both cameras in sync in a background thread
+        self.newFrame = threading.Event()
+        self.stereo = PodonatorLib.StereoGrabber(cam1, cam2, PodonatorLib.profile().mirror, new_frame=self.newFrame)
+        self.grabber1 = self.stereo.grabber1
+        self.grabber2 = self.stereo.grabber2
+
+    def run(self):
+        self.stereo.start()
+        try:
+            while self.running:
+                if not self.newFrame.wait(0.1):
+                    continue
+                self.newFrame.clear()
+                if self.pending:
+                    continue
+                timestamp1, img1, timestamp2, img2 = self.stereo.latest()
+                timestamp = min(timestamp1, timestamp2)
+                if self.stats is not None:
+                    self.stats.add("capture", time.perf_counter() - timestamp)
+                    self.stats.add("skew", abs(timestamp2 - timestamp1))
+                #Correct the preview directly at display resolution
+                with self.timed("correction"):
+                    img = PodonatorLib.preview_image(img1, img2, self.rotate, self.longSide)
+                if self.trigger is not None:
+                    with self.timed("motion"):
+                        autoAcquire = self.trigger.update(img, timestamp)
+                    if autoAcquire:
+                        self.img1, self.img2 = img1, img2
+                        self.autoAcquire.emit()
+                if self.stats is not None:
+                    self.stats.overlay(img)
+                #Convert to PyQt compatible colors
+                with self.timed("color"):
+                    img = cv.cvtColor(img, cv.COLOR_BGR2RGB)
+                h, w, ch = img.shape
+                bytesPerLine = ch * w
+                #Convert to PyQt compatible image (copied as the array is not kept)
+                qimg = QtGui.QImage(img.data, w, h, bytesPerLine, QtGui.QImage.Format_RGB888).copy()
+                self.img1, self.img2 = img1, img2
+                self.pending = True
+                self.frameReady.emit(qimg, timestamp)
+        except SystemExit as error:
+            self.failed.emit(str(error))
+        finally:
+            self.stereo.stop()
+
+    def timed(self, name):
+        """Times a stage if statistics are enabled"""
+        if self.stats is None:
+            return contextlib.nullcontext()
+        return self.stats.time(name)
+
+    def frameShown(self, qimg, timestamp): # pylint: disable=unused-argument
+        """Allows the next frame to be sent once the previous one is displayed"""
+        if self.stats is not None:
+            self.stats.frame(timestamp)
+        self.pending = False
+
+    def stop(self):
+        """Stops the preview and waits for the capture thread to end"""
+        self.running = False
+        self.wait()
+
 class imagePreview(QWidget):
     """Image preview window"""
-    def __init__(self):
+    done = QtCore.pyqtSignal()
+
+    def __init__(self, stats=None):
         super(imagePreview, self).__init__()
+        self.stats = stats
         self.toggle = True
         self.genOutput = False
         self.vlayout = QVBoxLayout()        # Window layout
@@ -96,86 +288,168 @@ class imagePreview(QWidget):
         """For capturing Escape key press event (same action as cancel button)"""
         if event.key() == Qt.Key_Escape:
             self.toggle = False
+            self.done.emit()
 
     def cancelAction(self):
         """Cancel button action"""
         self.toggle = False
+        self.done.emit()
 
     def acquireAction(self):
         """Acquire button action"""
         self.toggle = False
         self.genOutput = True
+        self.done.emit()
 
     def closeEvent(self, event):
         """Action when closing the preview window (same as cancel button)"""
         event.accept()
         self.toggle = False
+        self.done.emit()
+
+    def showFrame(self, qimg, timestamp): # pylint: disable=unused-argument
+        """Displays a preview image sent by the preview thread"""
+        start = time.perf_counter()
+        self.disp.resize(qimg.width(), qimg.height())
+        self.disp.setPixmap(QtGui.QPixmap.fromImage(qimg))
+        self.disp.repaint()
+        if self.stats is not None:
+            self.stats.add("display", time.perf_counter() - start)
+        if startupTimes is not None and "first_frame" not in startupTimes:
+            #Startup measured, the preview is no longer needed
+            startupTimes["first_frame"] = time.time()
+            self.cancelAction()
+
+class archiveBrowser(QWidget):
+    """Archive window : thumbnails of the archived captures of an output folder, newest first
+    Only the thumbnails stored in the archive are decoded, double click on a thumbnail to open the full size image"""
+    pageSize = 50 # Captures loaded at a time
+
+    def __init__(self, outputFolder, patient=""):
+        super().__init__()
+        import PodonatorArchive
+        self.archive = PodonatorArchive.Archive(outputFolder)
+        self.offset = 0
+        self.setWindowTitle("Podonator Archive - " + outputFolder)
+        self.setWindowIcon(getIcon())
+        self.patientEdit = QLineEdit(patient)
+        self.patientEdit.setPlaceholderText("All patients")
+        searchButton = QPushButton("Search")
+        self.moreButton = QPushButton("More")
+        self.thumbnails = QListWidget()
+        self.thumbnails.setViewMode(QListView.IconMode)
+        self.thumbnails.setResizeMode(QListView.Adjust)
+        self.thumbnails.setIconSize(QtCore.QSize(PodonatorArchive.thumbnail_size // 2, PodonatorArchive.thumbnail_size // 2))
+        layout = QGridLayout()
+        layout.addWidget(self.patientEdit, 0, 0, 1, 3)
+        layout.addWidget(searchButton, 0, 3)
+        layout.addWidget(self.thumbnails, 1, 0, 1, 4)
+        layout.addWidget(self.moreButton, 2, 0, 1, 4)
+        self.setLayout(layout)
+        self.resize(900, 600)
+        searchButton.clicked.connect(self.searchAction)
+        self.patientEdit.returnPressed.connect(self.searchAction)
+        self.moreButton.clicked.connect(self.loadPage)
+        self.thumbnails.itemDoubleClicked.connect(self.openImage)
+        self.searchAction()
+
+    def searchAction(self):
+        """Shows the first captures matching the patient"""
+        self.thumbnails.clear()
+        self.offset = 0
+        self.loadPage()
+
+    def loadPage(self):
+        """Adds the next captures to the list"""
+        captures = self.archive.query(self.patientEdit.text().strip() or None, limit=self.pageSize, offset=self.offset)
+        self.offset += len(captures)
+        self.moreButton.setEnabled(len(captures) == self.pageSize)
+        for capture in captures:
+            captureTime = datetime.datetime.fromtimestamp(capture["timestamp"]).strftime("%Y-%m-%d %H:%M")
+            for image in capture["images"]:
+                pixmap = QtGui.QPixmap()
+                pixmap.loadFromData(self.archive.thumbnail(image["id"]) or b"")
+                text = captureTime + " " + image["camera"].lstrip("_")
+                if capture["patient"]:
+                    text += "\n" + capture["patient"]
+                if image["length_mm"] is not None:
+                    text += "\n%.0f x %.0f mm" % (image["length_mm"], image["width_mm"])
+                item = QListWidgetItem(QtGui.QIcon(pixmap), text)
+                item.setData(Qt.UserRole, image["path"])
+                self.thumbnails.addItem(item)
 
-def show_images(cam1, cam2, rotate_bool):
-    """Shows the stream from the cameras (with full image correction) and allows for image capture returns the two captured images (one per camera)"""
+    def openImage(self, item):
+        """Opens the full size image with the default image viewer"""
+        QtGui.QDesktopServices.openUrl(QtCore.QUrl.fromLocalFile(item.data(Qt.UserRole)))
 
-    imageWindow = imagePreview()
+    def closeEvent(self, event):
+        """Closes the archive with the window"""
+        self.archive.close()
+        event.accept()
+
+def show_images(cam1, cam2, rotate_bool, stats=None):
+    """Shows the stream from the cameras (with full image correction) and allows for image capture returns the two captured images (one per camera)
+    stats is an optional PodonatorLib.PipelineStats timing each stage and drawing the frame rate and latency on the preview"""
+
+    imageWindow = imagePreview(stats)
     imageWindow.show()
     imageWindow.setWindowTitle("Podonator Preview")
     previewWindowLongSide = 960 # Number of pixels of the long side of the preview image
-    while imageWindow.toggle:
-        img1 = PodonatorLib.get_camera_image(PodonatorLib.mirror, cam1)
-        img2 = PodonatorLib.get_camera_image(PodonatorLib.mirror, cam2)
-        #Undistort
-        u_img1 = PodonatorLib.undistort_image(img1, PodonatorLib.K1, PodonatorLib.d1)
-        u_img2 = PodonatorLib.undistort_image(img2, PodonatorLib.K2, PodonatorLib.d2)
-        #Perspective correction
-        up_img1 = PodonatorLib.perpective_correction(u_img1, PodonatorLib.reference_cam1)
-        up_img2 = PodonatorLib.perpective_correction(u_img2, PodonatorLib.reference_cam2)
-        if rotate_bool:
-            #Concatenate the two streams in a single image
-            img = np.concatenate((cv.rotate(up_img1, cv.ROTATE_90_CLOCKWISE), cv.rotate(up_img2, cv.ROTATE_90_COUNTERCLOCKWISE)), axis=1)
-            #Image resolution to display
-            dim = (int(round(previewWindowLongSide * PodonatorLib.image_ratio))*2, previewWindowLongSide)
-        else:
-            img = np.concatenate((img1, img2), axis=0)
-            dim = (previewWindowLongSide, int(round(previewWindowLongSide * PodonatorLib.image_ratio))*2)
-        img = cv.resize(img, dim, interpolation=cv.INTER_AREA)
-        #Convert to PyQt compatible colors
-        img = cv.cvtColor(img, cv.COLOR_BGR2RGB)
-        h, w, ch = img.shape
-        bytesPerLine = ch * w
-        #Convert to PyQt compatible image
-        qimg = QtGui.QImage(img.data, w, h, bytesPerLine, QtGui.QImage.Format_RGB888)
-        qpximg = QtGui.QPixmap.fromImage(qimg)
-        imageWindow.disp.resize(img.shape[1], img.shape[0])
-        imageWindow.disp.setPixmap(qpximg)
-
-        cv.waitKey(1)
-
-    cam1.release()
-    cam2.release()
-
-    return up_img1, up_img2, imageWindow.genOutput
-
-def podorun(output_dir, left_camera_id, right_camera_id):
+    worker = previewWorker(cam1, cam2, rotate_bool, previewWindowLongSide, stats)
+    worker.frameReady.connect(imageWindow.showFrame)
+    worker.frameReady.connect(worker.frameShown)
+    worker.autoAcquire.connect(imageWindow.acquireAction)
+    worker.failed.connect(imageWindow.close)
+    worker.failed.connect(lambda message: QMessageBox.critical(None, "Error", message))
+    #Wait for Acquire or Cancel while the Qt event loop keeps running
+    loop = QtCore.QEventLoop()
+    imageWindow.done.connect(loop.quit)
+    worker.start()
+    loop.exec_()
+    #Left and right frames must be captured at the same time, whatever the acquisition mode
+    acquired = None
+    if imageWindow.genOutput and worker.img1 is not None:
+        acquired = worker.stereo.acquire_pair()
+    worker.stop()
+    imageWindow.close()
+
+    #Full resolution correction only for the acquired frames (merged once if a burst is acquired)
+    if imageWindow.genOutput and worker.img1 is not None:
+        if acquired is None:
+            QMessageBox.warning(None, "Error", "Left and right frames more than %d ms apart, images not acquired" % (PodonatorLib.max_skew * 1000))
+            return None, None, False
+        img1, img2, _ = acquired
+        up_img1, up_img2 = PodonatorLib.acquire_images(img1, img2, rotate_bool)
+        return up_img1, up_img2, True
+    return None, None, False
+
+def podorun(output_dir, left_camera_id, right_camera_id, show_stats=False):
     """Calls all previous functions"""
     os.chdir(str(Path(output_dir)))
-    #Initialize cameras
-    cam1 = PodonatorLib.init_camera(left_camera_id)
-    cam2 = PodonatorLib.init_camera(right_camera_id)
+    #Get the cameras kept open by the camera pool
+    cam1 = PodonatorLib.camera_pool().get(left_camera_id)
+    cam2 = PodonatorLib.camera_pool().get(right_camera_id)
     #Launch image preview, capture and correction
-    correct_img1, correct_img2, gen_output = show_images(cam1, cam2, PodonatorLib.rotate)
-    cam1.release()
-    cam2.release()
-    cv.destroyAllWindows()
+    stats = PodonatorLib.PipelineStats() if show_stats else None
+    correct_img1, correct_img2, gen_output = show_images(cam1, cam2, PodonatorLib.profile().rotate, stats)
+    now = datetime.datetime.now()
+    if stats is not None:
+        stats.dump(now.strftime("%Y-%m-%d-%H%M%S") + "_timing.json")
     if gen_output:
-        #Rotate images if necessary
-        if PodonatorLib.rotate:
-            correct_img1 = cv.rotate(correct_img1, cv.ROTATE_90_CLOCKWISE)
-            correct_img2 = cv.rotate(correct_img2, cv.ROTATE_90_COUNTERCLOCKWISE)
-        now = datetime.datetime.now()
         img_name = now.strftime("%Y-%m-%d-%H%M%S")
-        PodonatorLib.output_images(correct_img1, correct_img2, img_name, PodonatorLib.file_ext, PodonatorLib.image_dpi)
+        PodonatorLib.output_images(correct_img1, correct_img2, img_name, PodonatorLib.file_ext, PodonatorLib.profile().image_dpi, wait=False)
         #Open the file browser in the output folder
-        webbrowser.open(str(Path(output_dir)))
+        PodonatorLib.open_folder(output_dir)
         return
     return
+
+def startupTiming(podonatorGUI, path):
+    """Opens the preview (--startup_timing), then writes the startup times once the first frame was shown and quits"""
+    startupTimes["modules"] = time.time()
+    podonatorGUI.previewAction()
+    Path(path).write_text(json.dumps(startupTimes, indent=1))
+    QApplication.quit()
+
 def getIcon():
     """Window icon management"""
     try:
@@ -187,12 +461,28 @@ def getIcon():
     return qtIcon
 
 if __name__ == "__main__":
+    args, _ = getopt.getopt(sys.argv[1:], '', ['left_camera_id=', 'right_camera_id=', 'startup_timing='])
+    args = dict(args)
+    cameraIDs = None
+    if '--left_camera_id' in args or '--right_camera_id' in args:
+        cameraIDs = [args.get('--left_camera_id', 0), args.get('--right_camera_id', 1)]
     podonator = QApplication([])
-    podonatorGUI = podonatorWidget()
+    podonatorGUI = podonatorWidget(cameraIDs)
     podonatorGUI.setWindowTitle("Podonator v1.0")
     podonatorGUI.setWindowIcon(getIcon())
     # Window size
     podonatorGUI.resize(500, 150)
     podonatorGUI.show()
+    podonator.processEvents()
+    if '--startup_timing' in args:
+        startupTimes = {"window": time.time()}
+    #Load the image correction modules while the window is already shown
+    loader = moduleLoader()
+    loader.loaded.connect(podonatorGUI.modulesLoaded)
+    if '--startup_timing' in args:
+        loader.loaded.connect(lambda: startupTiming(podonatorGUI, args['--startup_timing']))
+    loader.start()
+    #Close the cameras kept open by the camera pool
+    podonator.aboutToQuit.connect(lambda: PodonatorLib.camera_pool().release() if PodonatorLib is not None else None)
 
     sys.exit(podonator.exec_())
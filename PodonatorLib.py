@@ -2,58 +2,546 @@
 import sys
 import datetime
 import os
-import webbrowser
+import hashlib
+import threading
+import time
+import collections
+import io
+import struct
+import zlib
+import zipfile
+import tempfile
+import concurrent.futures
+import queue
+import json
+import glob
+from contextlib import contextmanager
 from pathlib import Path
 import numpy as np
 import cv2 as cv
-from PIL import Image
 
-# Change values below for image modification if necessary
-mirror = False
-rotate = True
-image_dpi = 148
-image_ratio = 0.4369 # L325/W142
 #Define image format
 file_ext = ".jpg"
+#Camera resolution (width, height) and frame rate
+frame_size = (1920, 1080)
+frame_rate = 5
+#Capture backend used to open the cameras ("auto", "dshow", "v4l2", "any" or "file")
+capture_backend = os.environ.get("PODONATOR_CAPTURE_BACKEND", "auto")
+#OpenCV API and pixel format (FOURCC) requested by each capture backend
+capture_backends = {
+    "dshow": (cv.CAP_DSHOW, None),
+    "v4l2": (cv.CAP_V4L2, "MJPG"), # Without MJPG most UVC webcams fall back to uncompressed YUYV and a lower frame rate
+    "any": (cv.CAP_ANY, None),
+}
 
-# Use the calibration.py script to define the values below for each camera
-# Define camera matrix K for camera 1
-K1 = np.array([[805.6337330782276, 0.0, 956.9882395246467], [0.0, 816.8205144586113, 518.6594662094939], [0.0, 0.0, 1.0]])
+# Default calibration values, used when the station has no calibration profile (or for the values missing from it)
+# Use the fisheyeCalibration.py or calibrate.py scripts with --profile to write the values of each camera to a profile
+default_profile = {
+    "station": "default",
+    # Change values below for image modification if necessary
+    "mirror": False,
+    "rotate": True,
+    "image_dpi": 148,
+    "image_ratio": 0.4369, # L325/W142
+    # Lens model of each camera ("fisheye" or "pinhole" for normal lenses)
+    "model1": "fisheye",
+    "model2": "fisheye",
+    # Camera matrix K and distortion coefficients d for camera 1
+    "K1": np.array([[805.6337330782276, 0.0, 956.9882395246467], [0.0, 816.8205144586113, 518.6594662094939], [0.0, 0.0, 1.0]]),
+    "d1": np.array([[-0.06934545703899442], [0.2681174500565983], [-0.7915276083705534], [0.7514919779408756]]),
+    # Camera matrix K and distortion coefficients d for camera 2
+    "K2": np.array([[728.6058065554909, 0.0, 944.7599470057236], [0.0, 717.4035218893431, 512.8725335118967], [0.0, 0.0, 1.0]]),
+    "d2": np.array([[-0.008902607891725171], [0.09267206754490831], [-0.15736471202694802], [0.08299570424850797]]),
+    # Reference points for camera 1 and camera 2
+    "reference_cam1": np.float32([[290, 341], [1562, 317], [72, 943], [1834, 907]]),
+    "reference_cam2": np.float32([[290, 341], [1562, 317], [72, 943], [1834, 907]]),
+}
+# Cameras 3 and above of a camera array use the values of camera 1 for the calibration values missing from the profile
+# The profile can also give the orientation ("none", "cw", "ccw" or "180") and output file suffix of each camera
+# (orientation<n> and suffix<n>, defaults below) and the number of cameras of the station (camera_count)
+default_suffixes = {1: "_G", 2: "_D"}
+rotations = {"none": None, "cw": cv.ROTATE_90_CLOCKWISE, "ccw": cv.ROTATE_90_COUNTERCLOCKWISE, "180": cv.ROTATE_180}
+# Version of the calibration profile file format
+profile_version = 1
+# Default calibration profile file name (next to the script or the packaged executable)
+profile_name = "podonator_profile.npz"
+# Calibration profile of the station, loaded on first use
+_profile = None
 
-# Define distortion coefficients d for camera 1
-d1 = np.array([[-0.06934545703899442], [0.2681174500565983], [-0.7915276083705534], [0.7514919779408756]])
+# Background writer encoding and writing the output images
+_output_writer = None
+# Camera IDs probed when looking for the available cameras
+camera_candidates = range(8)
+# Cameras opened by the application
+_camera_pool = None
 
-# Define camera matrix K for camera 2
-K2 = np.array([[728.6058065554909, 0.0, 944.7599470057236], [0.0, 717.4035218893431, 512.8725335118967], [0.0, 0.0, 1.0]])
+#Acquisition mode : "single" (last frame of each camera), "median" or "mean" (temporal denoising of the last burst_size frames)
+#or "sharpest" (least blurred of the sharp_frames best frames read during the last sharp_window seconds)
+acquire_modes = ["single", "median", "mean", "sharpest"]
+acquire_mode = "single"
+burst_size = 5
+sharp_frames = 3
+sharp_window = 1.0
+#Width of the downscaled copy used to score the sharpness of the frames
+sharpness_width = 480
+#Largest time difference (s) allowed between the left and right frames of an acquired pair
+max_skew = 0.05
+#Hands-free capture : images are acquired once the feet stayed still for auto_capture_delay seconds after a movement
+#A frame is still when less than motion_threshold of its pixels changed by more than motion_pixel_threshold gray levels
+auto_capture = False
+auto_capture_delay = 2.0
+motion_threshold = 0.005
+motion_pixel_threshold = 20
+motion_width = 240
+# Preallocated frame stacks of the burst merge (frame count and shape : (stack, sum))
+_burst_stacks = {}
 
-# Define distortion coefficients d for camera 2
-d2 = np.array([[-0.008902607891725171], [0.09267206754490831], [-0.15736471202694802], [0.08299570424850797]])
+#Write the foot measurements (PodonatorMeasure) next to the output images
+measure_outputs = False
+#Add the output images with their thumbnails to the archive of the output folder (PodonatorArchive) and patient of the next captures
+archive_outputs = True
+patient = None
 
-# Reference points for camera 1
-reference_cam1 = np.float32([[290, 341], [1562, 317], [72, 943], [1834, 907]])
+# Image file extensions read by the file capture backend
+image_extensions = ['.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.pbm', '.pgm', '.ppm']
+# Raw frame recordings (replayed by the file capture backend) : file extension, header (magic, version, height, width, channels)
+recording_ext = ".podrec"
+recording_header = struct.Struct("<8sIIII")
+recording_magic = b"PODOREC\0"
+recording_version = 1
+# Replay speed of the file capture backend ("original" frame rate or "max" for as fast as possible)
+replay_speed = "original"
 
-# Reference points for camera 2
-reference_cam2 = np.float32([[290, 341], [1562, 317], [72, 943], [1834, 907]])
+# Folder name (next to the calibration data) where correction maps are saved between launches when there is no profile
+maps_folder = "maps"
+# File creation mask of the process (read once, os.umask can only be read by changing it)
+_umask = os.umask(0o022)
+os.umask(_umask)
+# Long sides of the preview correction maps saved with the calibration (preview window, camera array preview), other
+# sizes and the intermediate maps (undistortion, check_correction) are only kept in memory
+saved_preview_sizes = (960, 480)
+# Correction maps already built during this session
+_correction_maps = {}
+
+class Profile:
+    """Calibration profile of a station : lens calibration and reference points of each camera, output settings
+    and precomputed correction maps, stored in a single .npz file"""
+    def __init__(self, path=None):
+        self.path = path
+        self.maps = {} # Correction maps loaded or built during this session
+        self.stored_maps = set() # Correction maps of the profile file, only loaded when first needed
+        self.autosave = True # Save the profile as soon as new correction maps are stored
+        values = dict(default_profile)
+        maps_version = None
+        if path is not None and Path(path).exists():
+            with np.load(str(path)) as data:
+                version = int(data["version"]) if "version" in data.files else 1
+                if version > profile_version:
+                    sys.exit("ERROR : Calibration profile " + str(path) + " needs a newer version of Podonator")
+                for name in data.files:
+                    if name.startswith("map_"):
+                        self.stored_maps.add(name)
+                    elif name == "maps_version":
+                        maps_version = str(data[name])
+                    elif name != "version":
+                        values[name] = data[name]
+        self.station = str(values["station"])
+        self.mirror = bool(values["mirror"])
+        self.rotate = bool(values["rotate"])
+        self.image_dpi = int(values["image_dpi"])
+        self.image_ratio = float(values["image_ratio"])
+        self.model1 = str(values["model1"])
+        self.model2 = str(values["model2"])
+        self.K1 = np.array(values["K1"], dtype=np.float64)
+        self.d1 = np.array(values["d1"], dtype=np.float64)
+        self.K2 = np.array(values["K2"], dtype=np.float64)
+        self.d2 = np.array(values["d2"], dtype=np.float64)
+        self.reference_cam1 = np.array(values["reference_cam1"], dtype=np.float32)
+        self.reference_cam2 = np.array(values["reference_cam2"], dtype=np.float32)
+        # Values of the other cameras of a camera array (K3, orientation1...)
+        self.extra = {name: values[name].item() if np.ndim(values[name]) == 0 else values[name]
+                      for name in values if name not in default_profile}
+        self.camera_count = int(self.extra.pop("camera_count", 2))
+        self.maps_path = path
+        # Maps built with other calibration values are never used again, they are dropped on the next save
+        self.maps_version = calibration_version(self)
+        if maps_version != self.maps_version:
+            self.stored_maps = set()
+
+    def camera(self, index):
+        """Returns the calibration of a camera (1 to camera_count)"""
+        def value(name, default):
+            if name in default_profile:
+                return getattr(self, name)
+            return self.extra.get(name, default)
+        default_orientation = "none"
+        if self.rotate and index in (1, 2):
+            default_orientation = "cw" if index == 1 else "ccw"
+        return CameraCalibration(index, str(value("model%d" % index, self.model1)), value("K%d" % index, self.K1), value("d%d" % index, self.d1),
+                                 value("reference_cam%d" % index, self.reference_cam1), str(value("orientation%d" % index, default_orientation)),
+                                 str(value("suffix%d" % index, default_suffixes.get(index, "_%d" % index))))
+
+    def get_maps(self, name, key):
+        """Returns the correction maps stored in the profile (read from the profile file on first use), None if they are not"""
+        entry = "map_" + name + "_" + key
+        if entry + "_1" not in self.maps:
+            if entry + "_1" not in self.stored_maps:
+                return None
+            try:
+                with np.load(str(self.maps_path)) as data:
+                    self.maps[entry + "_1"], self.maps[entry + "_2"] = data[entry + "_1"], data[entry + "_2"]
+            except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+                self.stored_maps.difference_update((entry + "_1", entry + "_2"))
+                return None
+        return self.maps[entry + "_1"], self.maps[entry + "_2"]
+
+    def clear_maps(self):
+        """Forgets all correction maps (after a calibration change), they are dropped from the file on the next save"""
+        self.maps.clear()
+        self.stored_maps = set()
+        self.maps_version = calibration_version(self)
+
+    def set_maps(self, name, key, maps):
+        """Stores correction maps in the profile (written with save), the maps of a previous calibration are dropped"""
+        if calibration_version(self) != self.maps_version:
+            self.clear_maps()
+        entry = "map_" + name + "_" + key
+        self.maps[entry + "_1"], self.maps[entry + "_2"] = maps
+
+    def save(self, path=None):
+        """Writes the profile with its correction maps (through a unique temporary file so a profile is never left half
+        written, even if several processes save it)"""
+        self.path = path or self.path
+        values = {name: getattr(self, name) for name in default_profile}
+        values.update(self.extra)
+        values["camera_count"] = self.camera_count
+        if calibration_version(self) != self.maps_version:
+            self.clear_maps()
+        values["maps_version"] = self.maps_version
+        #Maps of the file not used during this session are kept
+        unloaded = [name for name in self.stored_maps if name not in self.maps]
+        if unloaded:
+            try:
+                with np.load(str(self.maps_path)) as data:
+                    values.update({name: data[name] for name in unloaded if name in data.files})
+            except (OSError, ValueError, zipfile.BadZipFile):
+                #Unreadable maps are dropped, they are built again when needed
+                pass
+        values.update(self.maps)
+        write_arrays(str(self.path), version=profile_version, **values)
+        self.maps_path = self.path
+        self.stored_maps = {name for name in values if name.startswith("map_")}
+
+class CameraCalibration:
+    """Calibration of one camera : lens model, camera matrix K and distortion coefficients d, perspective reference
+    points, orientation of its image and suffix of its output file"""
+    def __init__(self, index, model, K, d, reference, orientation="none", suffix=""):
+        if orientation not in rotations:
+            raise ValueError("Unknown orientation " + orientation + " for camera " + str(index))
+        self.index = index
+        self.model = model
+        self.K = np.array(K, dtype=np.float64)
+        self.d = np.array(d, dtype=np.float64)
+        self.reference = np.array(reference, dtype=np.float32)
+        self.orientation = orientation
+        self.rotate_code = rotations[orientation]
+        self.suffix = suffix
+
+def load_profile(path=None):
+    """Loads the calibration profile of the station
+    Without path, uses the PODONATOR_PROFILE environment variable then the profile next to the script or executable
+    Built-in default values are used if no profile file exists"""
+    global _profile # pylint: disable=global-statement
+    if path is None:
+        path = os.environ.get("PODONATOR_PROFILE")
+    if path is None and calibration_dir().joinpath(profile_name).exists():
+        path = calibration_dir().joinpath(profile_name)
+    _profile = Profile(path)
+    return _profile
+
+def profile():
+    """Returns the calibration profile of the station, loaded on first use"""
+    if _profile is None:
+        return load_profile()
+    return _profile
+
+def __getattr__(name):
+    """Gives access to the calibration values of the profile as module attributes (PodonatorLib.K1...)"""
+    if name in default_profile:
+        return getattr(profile(), name)
+    raise AttributeError("module 'PodonatorLib' has no attribute '" + name + "'")
+
+class CameraPool:
+    """Camera device manager, probes the camera IDs in parallel and keeps the validated cameras open
+    so they can be passed straight to the capture loop instead of being opened again"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.probing = threading.RLock() # Held while cameras are opened, so a camera is never opened twice
+        self.cameras = {} # Camera ID : opened camera
+        self.unavailable = set()
+
+    def open_camera(self, camera_id):
+        """Opens a camera and checks it delivers frames, returns the camera or None"""
+        cam = init_camera(camera_id)
+        if cam is None or not cam.isOpened():
+            return None
+        if not cam.read()[0]:
+            cam.release()
+            return None
+        return cam
+
+    def probe(self, camera_ids=None):
+        """Opens all the camera IDs not opened yet in parallel (camera_candidates by default)
+        Returns the list of available camera IDs"""
+        camera_ids = camera_candidates if camera_ids is None else camera_ids
+        with self.probing:
+            camera_ids = [camera_id for camera_id in dict.fromkeys(camera_ids) if camera_id not in self.cameras]
+            if camera_ids:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(camera_ids)) as executor:
+                    for camera_id, cam in zip(camera_ids, executor.map(self.open_camera, camera_ids)):
+                        with self.lock:
+                            if cam is None:
+                                self.unavailable.add(camera_id)
+                            else:
+                                self.cameras[camera_id] = cam
+                                self.unavailable.discard(camera_id)
+        return self.available()
+
+    def available(self):
+        """Returns the list of the camera IDs found so far"""
+        with self.lock:
+            return sorted(self.cameras, key=lambda camera_id: (isinstance(camera_id, str), str(camera_id).zfill(8)))
+
+    def get(self, camera_id):
+        """Returns the opened camera, opening it if it was not probed yet (None if it is not available)
+        Waits for a probe in progress instead of opening the camera a second time"""
+        with self.probing:
+            if camera_id not in self.cameras:
+                self.probe([camera_id])
+            with self.lock:
+                return self.cameras.get(camera_id)
+
+    def keep(self, camera_ids):
+        """Releases the opened cameras which are not in camera_ids (probing keeps every camera found open)"""
+        with self.lock:
+            unused = [camera_id for camera_id in self.cameras if camera_id not in camera_ids]
+        for camera_id in unused:
+            self.release(camera_id)
+
+    def release(self, camera_id=None):
+        """Releases a camera (all cameras if camera_id is None), it will be opened again on the next use"""
+        with self.lock:
+            camera_ids = list(self.cameras) if camera_id is None else [camera_id]
+            for camera_id in camera_ids:
+                cam = self.cameras.pop(camera_id, None)
+                if cam is not None:
+                    cam.release()
+
+def camera_pool():
+    """Returns the camera device manager of the application"""
+    global _camera_pool # pylint: disable=global-statement
+    if _camera_pool is None:
+        _camera_pool = CameraPool()
+    return _camera_pool
 
 # Test if the camera is connected
 # Returns False if not, True otherwise
 def test_camera(camera_id):
-    """Camera testing"""
-    cam = cv.VideoCapture(camera_id)
-    #ret_val, image = cam.read()
-    #if not ret_val:
-        #return False
-    if cam is None or not cam.isOpened():
+    """Camera testing, the camera is kept open in the camera pool"""
+    return camera_pool().get(camera_id) is not None
+
+class FrameRecorder:
+    """Records the raw frames of a camera in a frame file which can be memory-mapped : a header giving the frame shape
+    followed by fixed size records (capture timestamp and raw pixels), so a recording is replayed without any decoding
+    The file is created with the first frame"""
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.shape = None
+        self.count = 0 # Number of recorded frames
+
+    def add(self, timestamp, img):
+        """Appends a frame and its capture timestamp (s)"""
+        if self.file is None:
+            self.shape = img.shape
+            channels = img.shape[2] if img.ndim == 3 else 1
+            self.file = open(self.path, "wb")
+            self.file.write(recording_header.pack(recording_magic, recording_version, img.shape[0], img.shape[1], channels))
+        if img.shape != self.shape or img.dtype != np.uint8:
+            raise ValueError("Frame size changed during the recording of " + str(self.path))
+        self.file.write(struct.pack("<d", timestamp))
+        self.file.write(np.ascontiguousarray(img).data)
+        self.count += 1
+
+    def close(self):
+        """Closes the frame file"""
+        if self.file is not None:
+            self.file.close()
+
+def read_recording(path):
+    """Maps a raw frame recording in memory (an incomplete last record is ignored)
+    Returns a structured array of the records (timestamp and frame fields), frames are only read from the file when accessed"""
+    with open(str(path), "rb") as f:
+        magic, version, height, width, channels = recording_header.unpack(f.read(recording_header.size))
+    if magic != recording_magic:
+        raise ValueError(str(path) + " is not a Podonator recording")
+    if version > recording_version:
+        raise ValueError(str(path) + " needs a newer version of Podonator")
+    shape = (height, width, channels) if channels > 1 else (height, width)
+    dtype = np.dtype([("timestamp", "<f8"), ("frame", np.uint8, shape)])
+    count = (os.path.getsize(str(path)) - recording_header.size) // dtype.itemsize
+    if count <= 0:
+        return np.zeros(0, dtype)
+    return np.memmap(str(path), dtype, mode="r", offset=recording_header.size, shape=(count,))
+
+class FileCamera:
+    """File capture backend, stand-in for cv.VideoCapture replaying a video file, an image or an image sequence (folder,
+    glob or printf pattern), a raw frame recording or a list of images in a loop, so the whole pipeline can run without cameras
+    Frames are delivered at fps frames per second, recordings at their original pace (as fast as possible if fps is 0)
+    Like a capture device, grab only waits for the next frame and retrieve decodes it"""
+    def __init__(self, source, fps=frame_rate, loop=True):
+        self.fps = fps
+        self.loop = loop
+        self.frames = None # In memory (or memory-mapped) frames
+        self.timestamps = None # Capture times of the recorded frames
+        self.paths = None # Image sequence
+        self.video = None # Video file (or printf image sequence) read by OpenCV
+        if isinstance(source, (list, tuple)):
+            self.frames = list(source)
+        elif str(source).lower().endswith(recording_ext):
+            records = read_recording(source)
+            self.frames = records["frame"]
+            self.timestamps = records["timestamp"]
+        elif Path(source).is_dir():
+            self.paths = sorted(str(path) for path in Path(source).iterdir() if path.suffix.lower() in image_extensions)
+        elif glob.has_magic(source):
+            self.paths = sorted(glob.glob(source))
+        elif Path(source).suffix.lower() in image_extensions:
+            self.paths = [source]
+        else:
+            self.video = cv.VideoCapture(source)
+        self.index = 0
+        self.grabbed = None # Index of the grabbed frame, None if no frame is grabbed
+        self.frame = None # Last retrieved frame and its index
+        self.frame_index = None
+        self.opened = bool((self.frames is not None and len(self.frames)) or self.paths or (self.video is not None and self.video.isOpened()))
+        self.next_time = time.perf_counter()
+
+    def isOpened(self): # pylint: disable=invalid-name
+        """Same as cv.VideoCapture.isOpened"""
+        return self.opened
+
+    def grab(self):
+        """Same as cv.VideoCapture.grab, waits for the next frame time (the frame is decoded by retrieve)"""
+        if not self.opened:
+            return False
+        if self.fps:
+            delay = self.next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            interval = 1.0 / self.fps
+            if self.timestamps is not None and (self.index + 1) % len(self.timestamps):
+                #Original pace of the recording
+                i = self.index % len(self.timestamps)
+                interval = float(self.timestamps[i + 1] - self.timestamps[i])
+            self.next_time = max(self.next_time, time.perf_counter() - interval) + interval
+        self.grabbed = None
+        if self.video is not None:
+            #OpenCV decodes video frames when grabbing them, the video is only read by retrieve
+            ret_val = True
+            self.grabbed = self.index
+        else:
+            count = len(self.frames) if self.frames is not None else len(self.paths)
+            ret_val = self.loop or self.index < count
+            if ret_val:
+                self.grabbed = self.index % count
+        self.index += 1
+        return ret_val
+
+    def retrieve(self):
+        """Same as cv.VideoCapture.retrieve, decodes the grabbed frame"""
+        if self.grabbed is None:
+            return False, None
+        if self.video is not None and self.frame_index == self.grabbed:
+            return True, self.frame
+        if self.video is not None:
+            ret_val, frame = self.video.read()
+            if not ret_val and self.loop and self.grabbed:
+                self.video.set(cv.CAP_PROP_POS_FRAMES, 0)
+                ret_val, frame = self.video.read()
+        else:
+            frame = self.frames[self.grabbed].copy() if self.frames is not None else cv.imread(self.paths[self.grabbed])
+            ret_val = frame is not None
+        if ret_val:
+            self.frame, self.frame_index = frame, self.grabbed
+        return ret_val, frame
+
+    def read(self):
+        """Same as cv.VideoCapture.read"""
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def set(self, prop_id, value):
+        """Only the frame rate can be changed"""
+        if prop_id == cv.CAP_PROP_FPS:
+            self.fps = value
+            return True
         return False
-    cam.release()
-    return True
-
-def init_camera(camera_id):
-    """Camera initialization"""
-    cam = cv.VideoCapture(camera_id, cv.CAP_DSHOW)
-    cam.set(cv.CAP_PROP_FRAME_WIDTH, 1920)
-    cam.set(cv.CAP_PROP_FRAME_HEIGHT, 1080)
-    cam.set(cv.CAP_PROP_FPS, 5)
+
+    def get(self, prop_id):
+        """Same as cv.VideoCapture.get for the frame size and rate"""
+        if prop_id == cv.CAP_PROP_FPS:
+            return self.fps
+        if prop_id not in (cv.CAP_PROP_FRAME_WIDTH, cv.CAP_PROP_FRAME_HEIGHT) or not self.opened:
+            return 0
+        if self.video is not None:
+            return self.video.get(prop_id)
+        frame = self.frame
+        if frame is None:
+            frame = self.frames[0] if self.frames is not None else cv.imread(self.paths[0])
+        if frame is None:
+            return 0
+        return frame.shape[1] if prop_id == cv.CAP_PROP_FRAME_WIDTH else frame.shape[0]
+
+    def release(self):
+        """Same as cv.VideoCapture.release"""
+        self.opened = False
+        if self.video is not None:
+            self.video.release()
+
+def camera_id_value(value):
+    """Returns a camera ID from a command line value : camera index, or video file / image sequence path"""
+    return int(value) if str(value).isdigit() else value
+
+def camera_mode(cam):
+    """Returns the resolution, frame rate and pixel format (FOURCC) actually granted by a camera"""
+    fourcc = int(cam.get(cv.CAP_PROP_FOURCC))
+    fourcc = "".join(chr((fourcc >> 8 * i) & 0xff) for i in range(4)).strip("\0") if fourcc > 0 else "?"
+    return int(cam.get(cv.CAP_PROP_FRAME_WIDTH)), int(cam.get(cv.CAP_PROP_FRAME_HEIGHT)), cam.get(cv.CAP_PROP_FPS), fourcc
+
+def init_camera(camera_id, backend=None):
+    """Camera initialization with the capture backend (capture_backend by default)
+    camera_id is a camera index, or a video file / image sequence path which is replayed with the file backend"""
+    backend = backend or capture_backend
+    if backend == "file" or isinstance(camera_id, str):
+        return FileCamera(str(camera_id), fps=0 if replay_speed == "max" else frame_rate)
+    if backend == "auto":
+        backend = "dshow" if sys.platform == "win32" else "v4l2" if sys.platform.startswith("linux") else "any"
+    api, fourcc = capture_backends[backend]
+    cam = cv.VideoCapture(camera_id, api)
+    if not cam.isOpened():
+        return cam
+    #The pixel format must be set before the resolution
+    if fourcc:
+        cam.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*fourcc))
+    cam.set(cv.CAP_PROP_FRAME_WIDTH, frame_size[0])
+    cam.set(cv.CAP_PROP_FRAME_HEIGHT, frame_size[1])
+    cam.set(cv.CAP_PROP_FPS, frame_rate)
+    width, height, fps, granted_fourcc = camera_mode(cam)
+    print("Camera %s (%s) : %dx%d at %.1f fps (%s)" % (camera_id, backend, width, height, fps, granted_fourcc))
+    if (width, height) != tuple(frame_size):
+        print("WARNING : Camera %s resolution is not %dx%d, image correction will be wrong" % (camera_id, frame_size[0], frame_size[1]))
     return cam
 
 def get_camera_image(mirror_bool, cam):
@@ -66,31 +554,444 @@ def get_camera_image(mirror_bool, cam):
         img = cv.flip(img, 1)
     return img
 
+class FrameGrabber(threading.Thread):
+    """Background thread reading a camera continuously (applying mirroring if necessary)
+    Keeps a small ring buffer of timestamped frames so the newest frame is always available without blocking
+    new_frame is an optional threading.Event set for each frame read (it can be shared between grabbers)
+    recorder is an optional FrameRecorder receiving the raw frames (before mirroring), closed when the thread ends
+    score_frames keeps the sharpest recent frames for acquisition (only scored in the "sharpest" acquisition mode by default)
+    The buffer holds enough frames for an acquisition burst by default"""
+    def __init__(self, cam, mirror_bool=False, buffer_size=None, new_frame=None, recorder=None, score_frames=None):
+        super().__init__(daemon=True)
+        if buffer_size is None:
+            buffer_size = max(4, burst_size)
+        self.score_frames = acquire_mode == "sharpest" if score_frames is None else score_frames
+        self.sharp = [] # (score, timestamp, image) of the sharpest frames of the last sharp_window seconds, sharpest first
+        self.new_frame = new_frame
+        self.recorder = recorder
+        self.cam = cam
+        self.mirror = mirror_bool
+        self.frames = collections.deque(maxlen=buffer_size) # (timestamp, image) tuples, newest last
+        self.count = 0 # Number of frames read since the thread started
+        self.failed = False
+        self.running = True
+        self.condition = threading.Condition()
+
+    def run(self):
+        #A failure (camera, recorder or scoring error) ends the capture as failed instead of freezing on the last frame
+        try:
+            while self.running:
+                #Timestamp of the capture, before the frame is decoded
+                if not self.cam.grab():
+                    break
+                timestamp = time.perf_counter()
+                ret_val, img = self.cam.retrieve()
+                if not ret_val:
+                    break
+                self.add_frame(timestamp, img)
+        finally:
+            self.finish()
+
+    def add_frame(self, timestamp, img):
+        """Adds a raw frame read from the camera to the buffer"""
+        if self.recorder is not None:
+            self.recorder.add(timestamp, img)
+        if self.mirror:
+            img = cv.flip(img, 1)
+        score = sharpness(img) if self.score_frames else None
+        with self.condition:
+            self.frames.append((timestamp, img))
+            self.count += 1
+            if score is not None:
+                sharp = [entry for entry in self.sharp if entry[1] > timestamp - sharp_window] + [(score, timestamp, img)]
+                sharp.sort(key=lambda entry: entry[0], reverse=True)
+                self.sharp = sharp[:sharp_frames]
+            self.condition.notify_all()
+        if self.new_frame is not None:
+            self.new_frame.set()
+
+    def finish(self):
+        """Marks the end of the capture (failed if the thread was not stopped) and closes the recorder"""
+        with self.condition:
+            self.failed = self.running
+            self.condition.notify_all()
+        if self.new_frame is not None:
+            self.new_frame.set()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def latest(self, timeout=5.0):
+        """Returns the newest (timestamp, image), only waits if no frame has been read yet"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.frames or self.failed, timeout)
+            if self.failed or not self.frames:
+                sys.exit("ERROR : One or more cameras unavailable")
+            return self.frames[-1]
+
+    def recent(self):
+        """Returns a copy of the buffered (timestamp, image) tuples, oldest first"""
+        with self.condition:
+            return list(self.frames)
+
+    def sharpest(self):
+        """Returns the (score, timestamp, image) of the sharpest frame of the last sharp_window seconds, None if frames are not scored"""
+        with self.condition:
+            return self.sharp[0] if self.sharp else None
+
+    def stop(self):
+        """Stops the thread (the camera is not released)"""
+        self.running = False
+        self.join(timeout=2.0)
+
+class StereoGrabber(threading.Thread):
+    """Background thread reading both cameras in sync : both frames are grabbed back to back then decoded, so the left
+    and right images of a pair are captured as close as possible (two read() calls can be up to a frame interval apart)
+    grabber1 and grabber2 are the frame buffers of each camera (FrameGrabber, not started)"""
+    def __init__(self, cam1, cam2, mirror_bool=False, new_frame=None, frame_recorders=(None, None)):
+        super().__init__(daemon=True)
+        #One more frame than a burst, the newest frame of a camera can be read before its pair
+        buffer_size = max(4, burst_size + 1)
+        self.grabber1 = FrameGrabber(cam1, mirror_bool, buffer_size, new_frame=new_frame, recorder=frame_recorders[0])
+        self.grabber2 = FrameGrabber(cam2, mirror_bool, buffer_size, new_frame=new_frame, recorder=frame_recorders[1])
+        self.running = True
+
+    def run(self):
+        cam1, cam2 = self.grabber1.cam, self.grabber2.cam
+        try:
+            while self.running:
+                if not cam1.grab():
+                    break
+                timestamp1 = time.perf_counter()
+                if not cam2.grab():
+                    break
+                timestamp2 = time.perf_counter()
+                ret_val1, img1 = cam1.retrieve()
+                ret_val2, img2 = cam2.retrieve()
+                if not (ret_val1 and ret_val2):
+                    break
+                self.grabber1.add_frame(timestamp1, img1)
+                self.grabber2.add_frame(timestamp2, img2)
+        finally:
+            #Both buffers end (failed unless stopped) whatever stopped the loop
+            self.grabber1.running = self.grabber2.running = self.running
+            try:
+                self.grabber1.finish()
+            finally:
+                self.grabber2.finish()
+
+    def latest(self, timeout=5.0):
+        """Returns the newest pair of frames (see pair), only waits if no frame has been read yet"""
+        self.grabber1.latest(timeout)
+        self.grabber2.latest(timeout)
+        return self.pair()
+
+    def pair(self, max_skew_value=None):
+        """Pairs the buffered frames of both cameras by nearest timestamp
+        Returns the newest pair (timestamp1, image1, timestamp2, image2) with a skew under max_skew_value (s) if given, None if there is none"""
+        frames1 = self.grabber1.recent()
+        frames2 = self.grabber2.recent()
+        if not frames1 or not frames2:
+            return None
+        pairs = [(timestamp1, img1) + min(frames2, key=lambda frame: abs(frame[0] - timestamp1)) for timestamp1, img1 in frames1]
+        pairs += [min(frames1, key=lambda frame: abs(frame[0] - timestamp2)) + (timestamp2, img2) for timestamp2, img2 in frames2]
+        if max_skew_value is not None:
+            pairs = [pair for pair in pairs if abs(pair[2] - pair[0]) <= max_skew_value]
+        if not pairs:
+            return None
+        return max(pairs, key=lambda pair: (min(pair[0], pair[2]), -abs(pair[2] - pair[0])))
+
+    def synced_pair(self, timeout=1.0):
+        """Waits for a pair of frames with a skew under max_skew
+        Returns the pair (timestamp1, image1, timestamp2, image2), None if there is none after timeout seconds"""
+        end = time.perf_counter() + timeout
+        while True:
+            pair = self.pair(max_skew)
+            if pair is not None or time.perf_counter() > end or not self.is_alive():
+                return pair
+            time.sleep(0.01)
+
+    def acquire_pair(self, timeout=1.0):
+        """Returns the raw frames to acquire depending on acquire_mode, both frames of every pair used being at most
+        max_skew apart : synced pair (single), sharpest pair (sharpest) or merge of the last burst_size pairs (median, mean)
+        Returns (image1, image2, skew in seconds), None if the cameras have no frames close enough in time"""
+        if acquire_mode == "single":
+            pair = self.synced_pair(timeout)
+            return None if pair is None else (pair[1], pair[3], abs(pair[2] - pair[0]))
+        if acquire_mode == "sharpest":
+            return self.sharpest_pair()
+        frames2 = self.grabber2.recent()
+        if not frames2:
+            return None
+        pairs = [(timestamp1, img1) + min(frames2, key=lambda frame: abs(frame[0] - timestamp1)) for timestamp1, img1 in self.grabber1.recent()]
+        pairs = [pair for pair in pairs if abs(pair[2] - pair[0]) <= max_skew][-burst_size:]
+        if not pairs:
+            return None
+        return (merge_frames([pair[1] for pair in pairs], acquire_mode), merge_frames([pair[3] for pair in pairs], acquire_mode),
+                max(abs(pair[2] - pair[0]) for pair in pairs))
+
+    def sharpest_pair(self):
+        """Returns the sharpest pair (image1, image2, skew in seconds) of frames at most max_skew apart among the scored
+        frames and the buffered frames of both cameras (the product of the scores is used so each camera counts the same)
+        None if there is no such pair"""
+        candidates = []
+        for grabber in (self.grabber1, self.grabber2):
+            with grabber.condition:
+                frames = {timestamp: (score, timestamp, img) for score, timestamp, img in grabber.sharp}
+                recent = list(grabber.frames)
+            for timestamp, img in recent:
+                if timestamp not in frames:
+                    frames[timestamp] = (sharpness(img), timestamp, img)
+            candidates.append(list(frames.values()))
+        pairs = [(frame1, frame2) for frame1 in candidates[0] for frame2 in candidates[1] if abs(frame2[1] - frame1[1]) <= max_skew]
+        if not pairs:
+            return None
+        frame1, frame2 = max(pairs, key=lambda pair: pair[0][0] * pair[1][0])
+        return frame1[2], frame2[2], abs(frame2[1] - frame1[1])
+
+    def stop(self):
+        """Stops the thread (the cameras are not released)"""
+        self.running = False
+        self.join(timeout=2.0)
+
+class MotionTrigger:
+    """Hands-free capture trigger, frame differencing on small grayscale copies of the preview images
+    Armed by a movement (patient stepping on the podoscope), fires when no movement was seen for delay seconds"""
+    def __init__(self, delay=None):
+        self.delay = auto_capture_delay if delay is None else delay
+        self.previous = None
+        self.armed = False
+        self.still_since = None
+        self.motion = 0.0 # Fraction of the pixels changed since the previous frame
+
+    def update(self, img, timestamp):
+        """Compares a preview image with the previous one, timestamp is its capture time (s)
+        Returns True when the images must be acquired"""
+        h, w = img.shape[:2]
+        small = cv.resize(img, (motion_width, max(1, h * motion_width // w)), interpolation=cv.INTER_LINEAR)
+        if small.ndim == 3:
+            small = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+        #Smooth out the sensor noise
+        small = cv.GaussianBlur(small, (3, 3), 0)
+        previous, self.previous = self.previous, small
+        if previous is None or previous.shape != small.shape:
+            return False
+        changed = cv.threshold(cv.absdiff(small, previous), motion_pixel_threshold, 1, cv.THRESH_BINARY)[1]
+        self.motion = cv.countNonZero(changed) / changed.size
+        if self.motion > motion_threshold:
+            self.armed = True
+            self.still_since = timestamp
+            return False
+        if not self.armed or timestamp - self.still_since < self.delay:
+            return False
+        #Wait for a new movement before the next capture
+        self.armed = False
+        return True
+
+class PipelineStats:
+    """Opt-in timing of the preview pipeline stages, keeps rolling statistics over the last window values of each stage
+    and whole session statistics for the timing summary"""
+    def __init__(self, window=50):
+        self.window = window
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict() # Stage name : last durations (s)
+        self.session = {} # Stage name : [count, total, max] over the whole session
+        self.frames = collections.deque(maxlen=window) # Display times of the last frames
+        self.start_time = time.perf_counter()
+
+    def add(self, name, duration):
+        """Records the duration (s) of a stage"""
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = collections.deque(maxlen=self.window)
+                self.session[name] = [0, 0.0, 0.0]
+            self.stages[name].append(duration)
+            session = self.session[name]
+            session[0] += 1
+            session[1] += duration
+            session[2] = max(session[2], duration)
+
+    @contextmanager
+    def time(self, name):
+        """Times the enclosed block as a stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def frame(self, timestamp):
+        """Records a displayed frame, timestamp is the capture time of the frame (for the end to end latency)"""
+        now = time.perf_counter()
+        self.add("latency", now - timestamp)
+        with self.lock:
+            self.frames.append(now)
+
+    def fps(self):
+        """Returns the displayed frame rate over the last frames"""
+        with self.lock:
+            if len(self.frames) < 2:
+                return 0.0
+            return (len(self.frames) - 1) / (self.frames[-1] - self.frames[0])
+
+    def means(self):
+        """Returns the rolling mean duration (ms) of each stage"""
+        with self.lock:
+            return collections.OrderedDict((name, 1000 * sum(values) / len(values)) for name, values in self.stages.items())
+
+    def overlay(self, img):
+        """Draws the frame rate and the duration of each stage on the image (in place)"""
+        lines = ["%.1f fps" % self.fps()] + ["%s %.1f ms" % (name, value) for name, value in self.means().items()]
+        for i, line in enumerate(lines):
+            y = 20 + 18 * i
+            cv.putText(img, line, (11, y + 1), cv.FONT_HERSHEY_PLAIN, 1.0, (0, 0, 0), thickness=2, lineType=cv.LINE_AA)
+            cv.putText(img, line, (10, y), cv.FONT_HERSHEY_PLAIN, 1.0, (255, 255, 255), lineType=cv.LINE_AA)
+        return img
 
-def show_images(cam1, cam2, rotate_bool):
+    def summary(self):
+        """Returns the session timing summary (count, mean, max and last window percentiles in ms per stage)"""
+        with self.lock:
+            stages = {}
+            for name, (count, total, maximum) in self.session.items():
+                values = np.array(self.stages[name]) * 1000
+                stages[name] = {"count": count, "mean_ms": 1000 * total / count, "max_ms": 1000 * maximum,
+                                "p50_ms": float(np.percentile(values, 50)), "p90_ms": float(np.percentile(values, 90))}
+        return {"duration_s": time.perf_counter() - self.start_time, "fps": self.fps(), "stages": stages}
+
+    def dump(self, path):
+        """Writes the session timing summary as JSON"""
+        Path(path).write_text(json.dumps(self.summary(), indent=1))
+        print("Timing summary written to", path)
+
+def rotation_codes(rotate_bool):
+    """Returns the rotation applied to the image of each camera (90 degrees CW for camera 1, CCW for camera 2)"""
+    if rotate_bool:
+        return cv.ROTATE_90_CLOCKWISE, cv.ROTATE_90_COUNTERCLOCKWISE
+    return None, None
+
+def preview_image(img1, img2, rotate_bool, long_side=960):
+    """Corrects the raw images of both cameras directly at display resolution (long_side pixels)
+    Returns the two streams concatenated in a single image"""
+    cal = profile()
+    rotate_code1, rotate_code2 = rotation_codes(rotate_bool)
+    short_side = int(round(long_side * cal.image_ratio))
+    if rotate_bool:
+        size = (short_side, long_side)
+    else:
+        size = (long_side, short_side)
+    p_img1 = correct_image(img1, cal.K1, cal.d1, cal.reference_cam1, rotate_code1, size, cal.model1)
+    p_img2 = correct_image(img2, cal.K2, cal.d2, cal.reference_cam2, rotate_code2, size, cal.model2)
+    #Concatenate the two streams in a single image
+    return np.concatenate((p_img1, p_img2), axis=1 if rotate_bool else 0)
+
+def acquire_images(img1, img2, rotate_bool):
+    """Corrects the raw images of both cameras at full resolution
+    Returns the two corrected images"""
+    cal = profile()
+    rotate_code1, rotate_code2 = rotation_codes(rotate_bool)
+    #Undistort, perspective correction and rotation in a single pass
+    up_img1 = correct_image(img1, cal.K1, cal.d1, cal.reference_cam1, rotate_code1, model=cal.model1)
+    up_img2 = correct_image(img2, cal.K2, cal.d2, cal.reference_cam2, rotate_code2, model=cal.model2)
+    return up_img1, up_img2
+
+def recorders(record):
+    """Returns the frame recorders of both cameras for the record naming pattern (None if record is None)"""
+    if record is None:
+        return None, None
+    return FrameRecorder(record + "_G" + recording_ext), FrameRecorder(record + "_D" + recording_ext)
+
+def sharpness(img):
+    """Returns the sharpness score of a frame (variance of the Laplacian of a downscaled grayscale copy, lower when blurred)
+    Takes less than a millisecond for a 1920x1080 frame"""
+    h, w = img.shape[:2]
+    small = cv.resize(img, (sharpness_width, max(1, h * sharpness_width // w)), interpolation=cv.INTER_LINEAR)
+    if small.ndim == 3:
+        small = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+    return float(cv.meanStdDev(cv.Laplacian(small, cv.CV_16S))[1][0, 0] ** 2)
+
+def merge_frames(frames, mode="median"):
+    """Temporal denoising of a burst of frames of a camera, per pixel median or mean of the frames (the median of an
+    even number of frames is the rounded mean of the two middle values)
+    The frames are copied to a preallocated stack which is sorted in place (odd-even transposition with vectorized
+    min/max, much faster than np.median on uint8 images)
+    Returns the merged frame"""
+    count = len(frames)
+    key = (count,) + frames[0].shape
+    if key not in _burst_stacks:
+        _burst_stacks[key] = (np.empty(key, np.uint8), np.empty(key[1:], np.uint16))
+    stack, total = _burst_stacks[key]
+    for i, frame in enumerate(frames):
+        np.copyto(stack[i], frame)
+    if mode == "mean":
+        np.sum(stack, axis=0, dtype=np.uint16, out=total)
+        total += count // 2
+        total //= count
+        return total.astype(np.uint8)
+    if mode != "median":
+        raise ValueError("Unknown acquisition mode " + str(mode))
+    low = np.empty_like(stack[0])
+    for step in range(count):
+        for i in range(step % 2, count - 1, 2):
+            np.minimum(stack[i], stack[i + 1], out=low)
+            np.maximum(stack[i], stack[i + 1], out=stack[i + 1])
+            stack[i] = low
+    if count % 2 == 0:
+        np.add(stack[count // 2 - 1], stack[count // 2], out=total, dtype=np.uint16)
+        total += 1
+        total //= 2
+        return total.astype(np.uint8)
+    return stack[count // 2].copy()
+
+def acquire_frame(grabber, img):
+    """Returns the raw frame of a camera to acquire depending on acquire_mode : img (last previewed frame),
+    the sharpest recent frame or the merge of the last burst_size frames read by the grabber"""
+    if acquire_mode == "single":
+        return img
+    if acquire_mode == "sharpest":
+        sharpest = grabber.sharpest()
+        return img if sharpest is None else sharpest[2]
+    frames = [frame for _, frame in grabber.recent()][-burst_size:]
+    return merge_frames(frames, acquire_mode)
+
+def show_images(cam1, cam2, rotate_bool, stats=None, record=None):
     """Shows the stream from the cameras and allows for image capture
-    Returns the two captured images (one per camera)"""
+    stats is an optional PipelineStats timing each stage and drawing the frame rate and latency on the preview
+    record is an optional naming pattern, the raw frames of both cameras are recorded to <record>_G.podrec and <record>_D.podrec
+    Returns the two captured images (one per camera, corrected and rotated)"""
     toggle = True
     gen_output = False
+    #Read both cameras in sync in a background thread
+    new_frame = threading.Event()
+    stereo = StereoGrabber(cam1, cam2, profile().mirror, new_frame=new_frame, frame_recorders=recorders(record))
+    grabber1, grabber2 = stereo.grabber1, stereo.grabber2
+    trigger = MotionTrigger() if auto_capture else None
+    auto_acquire = False
+    stereo.start()
     while toggle:
-        img1 = get_camera_image(mirror, cam1)
-        img2 = get_camera_image(mirror, cam2)
-        #Undistort
-        u_img1 = undistort_image(img1, K1, d1)
-        u_img2 = undistort_image(img2, K2, d2)
-        #Perspective correction
-        up_img1 = perpective_correction(u_img1, reference_cam1)
-        up_img2 = perpective_correction(u_img2, reference_cam2)
-        if rotate_bool:
-            #Concatenate the two streams in a single image
-            img = np.concatenate((cv.rotate(up_img1, cv.ROTATE_90_CLOCKWISE), cv.rotate(up_img2, cv.ROTATE_90_COUNTERCLOCKWISE)), axis=1)
-            #Image resolution to display
-            dim = (int(round(960 * image_ratio))*2, 960)
-        else:
-            img = np.concatenate((img1, img2), axis=0)
-            dim = (960, int(round(960 * image_ratio))*2)
-        img = cv.resize(img, dim, interpolation=cv.INTER_AREA)
-        cv.imshow("Podoscope Preview - Spacebar to acquire or Esc to cancel", img)
+        #A camera which stopped delivering frames ends the preview, the buffered frames are not acquired
+        if grabber1.failed or grabber2.failed:
+            stereo.stop()
+            sys.exit("ERROR : One or more cameras unavailable")
+        #Only process the preview when a camera delivered a new frame
+        if new_frame.is_set():
+            new_frame.clear()
+            timestamp1, img1, timestamp2, img2 = stereo.latest()
+            #Correct the preview directly at display resolution
+            if stats is None:
+                img = preview_image(img1, img2, rotate_bool)
+                auto_acquire = trigger is not None and trigger.update(img, min(timestamp1, timestamp2))
+                cv.imshow("Podoscope Preview - Spacebar to acquire or Esc to cancel", img)
+            else:
+                stats.add("capture", time.perf_counter() - min(timestamp1, timestamp2))
+                stats.add("skew", abs(timestamp2 - timestamp1))
+                with stats.time("correction"):
+                    img = preview_image(img1, img2, rotate_bool)
+                if trigger is not None:
+                    with stats.time("motion"):
+                        auto_acquire = trigger.update(img, min(timestamp1, timestamp2))
+                stats.overlay(img)
+                with stats.time("display"):
+                    cv.imshow("Podoscope Preview - Spacebar to acquire or Esc to cancel", img)
+                stats.frame(min(timestamp1, timestamp2))
         keypress = cv.waitKey(1)
         if keypress%256 == 27:
             #ESC pressed
@@ -98,64 +999,681 @@ def show_images(cam1, cam2, rotate_bool):
             toggle = False
             gen_output = False
             print("Cancelled")
-        elif keypress%256 == 32:
-            #SPACE pressed
-            toggle = False
-            gen_output = True
-            print("Images acquired")
+        elif keypress%256 == 32 or auto_acquire:
+            #SPACE pressed or feet still long enough
+            acquired = stereo.acquire_pair()
+            if acquired is None:
+                print("Left and right frames more than %d ms apart, images not acquired" % (max_skew * 1000))
+            else:
+                toggle = False
+                gen_output = True
+                img1, img2, skew = acquired
+                print("Images acquired" if keypress%256 == 32 else "Images acquired automatically", "(skew %.1f ms)" % (skew * 1000))
+            auto_acquire = False
+    stereo.stop()
+    #Full resolution correction only for the acquired frames (merged once if a burst is acquired)
+    if gen_output:
+        up_img1, up_img2 = acquire_images(img1, img2, rotate_bool)
+    else:
+        up_img1, up_img2 = None, None
     return up_img1, up_img2, gen_output
 
-def undistort_image(img, K, d):
+def undistort_image(img, K, d, model="fisheye"):
     """Applies correction for lens distortion (K and D parameters obtained through OpenCV calibration for each camera)
     Returns the image with applied lens distortion correction"""
     # Read the image and get its size
     h, w = img.shape[:2]
-    # Generate look-up tables for remapping the camera image
-    mapx, mapy = cv.fisheye.initUndistortRectifyMap(K, d, np.eye(3), K, (w, h), cv.CV_16SC2) # pylint: disable=no-member
+    # Get look-up tables for remapping the camera image
+    mapx, mapy = undistort_maps(K, d, (w, h), model=model)
     # Remap the original image to a new image
     newimg = cv.remap(img, mapx, mapy, interpolation=cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT)
     return newimg
 
+def calibration_dir():
+    """Returns the folder holding the calibration data (next to the script or the packaged executable)"""
+    if getattr(sys, 'frozen', False):
+        return Path(sys.executable).parent
+    return Path(__file__).parent
+
+def map_key(*args):
+    """Returns a short digest identifying a correction map from the values it was built with"""
+    digest = hashlib.sha1()
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            arg = np.ascontiguousarray(arg, dtype=np.float64)
+            digest.update(arg.tobytes())
+        else:
+            digest.update(repr(arg).encode())
+    return digest.hexdigest()[:16]
+
+def calibration_version(cal=None):
+    """Returns a short digest of the calibration and output parameters (of the station profile by default),
+    changes whenever corrected images would change"""
+    cal = cal or profile()
+    return map_key(cal.model1, cal.K1, cal.d1, cal.model2, cal.K2, cal.d2, cal.reference_cam1, cal.reference_cam2,
+                   cal.image_ratio, cal.image_dpi, cal.mirror, cal.rotate, file_ext, *[cal.extra[name] for name in sorted(cal.extra)])
+
+def cached_maps(name, key, build, persist=True):
+    """Returns the correction maps identified by key, calling build() only if they are neither in memory nor on disk
+    Maps are saved (if persist is True) in the calibration profile (or in the maps folder next to the calibration data
+    if the station has no profile file) so the next launch loads them instead of recomputing them"""
+    maps = _correction_maps.get((name, key))
+    if maps is not None:
+        return maps
+    if not persist:
+        maps = _correction_maps[(name, key)] = build()
+        return maps
+    cal = profile()
+    if cal.path is not None:
+        maps = cal.get_maps(name, key)
+        if maps is None:
+            maps = build()
+            cal.set_maps(name, key, maps)
+            try:
+                if cal.autosave:
+                    cal.save()
+            except OSError:
+                print("WARNING : Unable to save correction maps to", cal.path)
+        _correction_maps[(name, key)] = maps
+        return maps
+    map_file = calibration_dir().joinpath(maps_folder, name + "_" + key + ".npz")
+    try:
+        with np.load(str(map_file)) as data:
+            maps = (data["map1"], data["map2"])
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        #Missing or damaged map file (written by an older version), built again
+        maps = build()
+        try:
+            map_file.parent.mkdir(exist_ok=True)
+            write_arrays(str(map_file), map1=maps[0], map2=maps[1])
+        except OSError:
+            print("WARNING : Unable to save correction maps to", map_file)
+    _correction_maps[(name, key)] = maps
+    return maps
+
+def undistort_maps(K, d, size, map_type=cv.CV_16SC2, model="fisheye"):
+    """Returns the undistortion look-up tables for a camera and a frame size (w, h)
+    Tables are built once per calibration, changing K or d gives a new key and rebuilds them"""
+    def build():
+        if model == "pinhole":
+            return cv.initUndistortRectifyMap(K, d, np.eye(3), K, tuple(size), map_type)
+        return cv.fisheye.initUndistortRectifyMap(K, d, np.eye(3), K, tuple(size), map_type) # pylint: disable=no-member
+    key = map_key(K, d, tuple(size), map_type) if model == "fisheye" else map_key(model, K, d, tuple(size), map_type)
+    return cached_maps("undistort", key, build, persist=False)
+
 def perpective_correction(img, reference):
     """Perspective correction"""
     h, w = img.shape[:2]
     target = np.float32([[0, 0], [w, 0], [0, h], [w, h]])
     M = cv.getPerspectiveTransform(reference, target)
     newimg = cv.warpPerspective(img, M, (w, h))
-    newimg = cv.resize(newimg, (w, int(round(w * image_ratio))))
+    newimg = cv.resize(newimg, (w, int(round(w * profile().image_ratio))))
     return newimg
 
-def output_images(img1, img2, naming_pattern, file_extension, image_dpi_value):
-    """Image generation"""
-    cv.imwrite(naming_pattern+"_G"+file_extension, img1)
-    cv.imwrite(naming_pattern+"_D"+file_extension, img2)
-    #Adjust image DPI for printing
-    im = Image.open(naming_pattern+"_G"+file_extension)
-    im.save(naming_pattern+"_G"+file_extension, dpi=(image_dpi_value, image_dpi_value))
-    im = Image.open(naming_pattern+"_D"+file_extension)
-    im.save(naming_pattern+"_D"+file_extension, dpi=(image_dpi_value, image_dpi_value))
-    return
+def order_points(points):
+    """Orders the four corners of a quad as the reference points : top left, top right, bottom left, bottom right"""
+    points = np.float32(points).reshape(4, 2)
+    total = points.sum(axis=1)
+    diff = points[:, 1] - points[:, 0]
+    return np.float32([points[np.argmin(total)], points[np.argmin(diff)], points[np.argmax(diff)], points[np.argmax(total)]])
+
+def refine_quad(gray, corners, search=8):
+    """Refines the corners of a quad (reference points order) to sub-pixel accuracy : the strongest gradient is searched
+    across each side (up to search pixels away), a line is fitted to these edge points and the corners are the
+    intersections of adjacent sides (cornerSubPix is only accurate on chessboard corners, not on the corners of a filled quad)
+    Returns the refined corners, the original corner of two sides which could not be fitted"""
+    gradient_x = cv.Sobel(gray, cv.CV_32F, 1, 0, ksize=3)
+    gradient_y = cv.Sobel(gray, cv.CV_32F, 0, 1, ksize=3)
+    polygon = corners[[0, 1, 3, 2]].astype(np.float64) # Clockwise : top left, top right, bottom right, bottom left
+    offsets = np.arange(-search, search + 1, dtype=np.float64)
+    lines = []
+    for start, end in zip(polygon, np.roll(polygon, -1, axis=0)):
+        length = np.linalg.norm(end - start)
+        direction = (end - start) / length
+        normal = np.array([-direction[1], direction[0]])
+        #Points along the side away from the corners, sampled across the side
+        along = start + np.linspace(0.1, 0.9, max(8, int(length / 4)))[:, None] * (end - start)
+        samples = (along[:, None, :] + offsets[None, :, None] * normal).astype(np.float32)
+        map_x, map_y = np.ascontiguousarray(samples[..., 0]), np.ascontiguousarray(samples[..., 1])
+        across = np.abs(cv.remap(gradient_x, map_x, map_y, cv.INTER_LINEAR) * normal[0] + cv.remap(gradient_y, map_x, map_y, cv.INTER_LINEAR) * normal[1])
+        #Edge position : centroid of the gradient around its peak
+        peak = np.clip(np.argmax(across, axis=1), 4, len(offsets) - 5)
+        window = peak[:, None] + np.arange(-4, 5)
+        weights = np.take_along_axis(across, window, axis=1)
+        weights = np.maximum(weights - weights.min(axis=1, keepdims=True), 0)
+        valid = weights.sum(axis=1) > 0
+        if np.count_nonzero(valid) < 2:
+            lines.append(None)
+            continue
+        position = (weights * offsets[window]).sum(axis=1)[valid] / weights.sum(axis=1)[valid]
+        points = along[valid] + position[:, None] * normal
+        lines.append(cv.fitLine(points.astype(np.float32), cv.DIST_HUBER, 0, 0.01, 0.01).ravel())
+    refined = polygon.copy()
+    for index in range(4):
+        previous, line = lines[index - 1], lines[index]
+        if previous is None or line is None:
+            continue
+        #Intersection of the side ending at this corner and the side starting at it
+        matrix = np.array([[previous[0], -line[0]], [previous[1], -line[1]]])
+        if abs(np.linalg.det(matrix)) < 1e-6:
+            continue
+        t = np.linalg.solve(matrix, line[2:] - previous[2:])[0]
+        refined[index] = previous[2:] + t * previous[:2]
+    return np.float32(refined[[0, 1, 3, 2]])
+
+def find_reference(img, min_area=0.05):
+    """Finds the calibration cardboard rectangle (the largest quad covering at least min_area of the image)
+    in an undistorted image, the corners are refined to sub-pixel accuracy (line fitted to each side)
+    Returns the reference points (top left, top right, bottom left, bottom right), None if no rectangle was found"""
+    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    blurred = cv.GaussianBlur(gray, (7, 7), 0)
+    #Edge detection, dilation + erosion close the gaps in the cardboard edges
+    edged = cv.Canny(blurred, 50, 100)
+    edged = cv.erode(cv.dilate(edged, None, iterations=1), None, iterations=1)
+    contours = cv.findContours(edged, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)[-2]
+    for contour in sorted(contours, key=cv.contourArea, reverse=True):
+        if cv.contourArea(contour) < min_area * gray.shape[0] * gray.shape[1]:
+            break
+        #Smallest simplification giving a quad, larger ones cut the obtuse corners
+        hull = cv.convexHull(contour)
+        for epsilon in np.linspace(0.002, 0.05, 25) * cv.arcLength(hull, True):
+            quad = cv.approxPolyDP(hull, epsilon, True)
+            if len(quad) <= 4:
+                break
+        if len(quad) != 4:
+            #Slightly rounded corners : use the rotated bounding box
+            quad = cv.boxPoints(cv.minAreaRect(contour))
+        return refine_quad(blurred, order_points(quad))
+    return None
+
+def detect_reference(cam, K, d, model="fisheye", check_image=None):
+    """Finds the calibration cardboard in an undistorted frame of a camera (mirrored if necessary, like the captured images)
+    check_image is an optional path where the undistorted frame is written with the rectangle found
+    Returns the reference points, None if the cardboard was not found"""
+    img = undistort_image(get_camera_image(profile().mirror, cam), K, d, model)
+    reference = find_reference(img)
+    if check_image is not None:
+        if reference is not None:
+            cv.polylines(img, [reference[[0, 1, 3, 2]].round().astype(np.int32)], True, (0, 255, 0), 2, cv.LINE_AA)
+        cv.imwrite(str(check_image), img)
+    return reference
+
+def correction_maps(K, d, reference, size, rotate_code=None, output_size=None, map_type=cv.CV_16SC2, model="fisheye"):
+    """Returns the look-up tables going straight from the raw camera pixel (frame size (w, h)) to the corrected pixel
+    Undistortion, perspective correction, resizing to image_ratio and rotation are composed in a single remap which only
+    reads the pixels inside the reference quad. output_size (w, h) scales the result (defaults to the full resolution)"""
+    image_ratio = profile().image_ratio
+    def build():
+        w, h = size
+        # Size of the perspective corrected image before rotation
+        h_ratio = int(round(w * image_ratio))
+        full_w, full_h = (h_ratio, w) if rotate_code in (cv.ROTATE_90_CLOCKWISE, cv.ROTATE_90_COUNTERCLOCKWISE) else (w, h_ratio)
+        out_w, out_h = output_size or (full_w, full_h)
+        # Output pixel centers in full resolution coordinates
+        x = (np.arange(out_w, dtype=np.float64) + 0.5) * full_w / out_w - 0.5
+        y = (np.arange(out_h, dtype=np.float64) + 0.5) * full_h / out_h - 0.5
+        x, y = np.meshgrid(x, y)
+        # Undo rotation
+        if rotate_code == cv.ROTATE_90_CLOCKWISE:
+            x, y = y, h_ratio - 1 - x
+        elif rotate_code == cv.ROTATE_90_COUNTERCLOCKWISE:
+            x, y = w - 1 - y, x
+        elif rotate_code == cv.ROTATE_180:
+            x, y = w - 1 - x, h_ratio - 1 - y
+        # Undo resizing to image_ratio
+        y = (y + 0.5) * h / h_ratio - 0.5
+        # Undo perspective correction
+        target = np.float32([[0, 0], [w, 0], [0, h], [w, h]])
+        M_inv = np.linalg.inv(cv.getPerspectiveTransform(reference, target))
+        s = M_inv[2, 0] * x + M_inv[2, 1] * y + M_inv[2, 2]
+        u = (M_inv[0, 0] * x + M_inv[0, 1] * y + M_inv[0, 2]) / s
+        v = (M_inv[1, 0] * x + M_inv[1, 1] * y + M_inv[1, 2]) / s
+        # Undo undistortion (undistorted image uses K as its camera matrix)
+        points = np.dstack(((u - K[0, 2]) / K[0, 0], (v - K[1, 2]) / K[1, 1])).reshape(-1, 1, 2)
+        if model == "pinhole":
+            points = np.dstack((points, np.ones(points.shape[:2])))
+            raw, _ = cv.projectPoints(points, np.zeros(3), np.zeros(3), K, d)
+        else:
+            raw = cv.fisheye.distortPoints(points, K, d) # pylint: disable=no-member
+        raw = raw.reshape(out_h, out_w, 2).astype(np.float32)
+        if map_type == cv.CV_32FC1:
+            return raw[..., 0].copy(), raw[..., 1].copy()
+        return cv.convertMaps(raw[..., 0], raw[..., 1], map_type)
+    key = map_key(model, K, d, reference, tuple(size), rotate_code, output_size and tuple(output_size), image_ratio, map_type)
+    persist = map_type == cv.CV_16SC2 and (output_size is None or max(output_size) in saved_preview_sizes)
+    return cached_maps("correction", key, build, persist)
+
+def correct_image(img, K, d, reference, rotate_code=None, output_size=None, model="fisheye"):
+    """Applies lens distortion correction, perspective correction, resizing and rotation with a single remap
+    Returns the corrected image (same result as undistort_image, perpective_correction and cv.rotate)"""
+    h, w = img.shape[:2]
+    map1, map2 = correction_maps(K, d, reference, (w, h), rotate_code, output_size, model=model)
+    return cv.remap(img, map1, map2, interpolation=cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT)
+
+def check_correction_maps(K, d, reference, size, rotate_code=None, tolerance=0.5, model="fisheye"):
+    """Compares the single pass correction with the multi-step one (undistort, perspective correction, resize, rotate)
+    Both paths are applied to images holding the raw pixel coordinates, so their results are the raw pixels each output pixel samples
+    Returns the largest distance in pixels between both paths, raises ValueError if it is above tolerance"""
+    w, h = size
+    x, y = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+    coords = np.dstack((x, y, np.ones_like(x)))
+    steps = perpective_correction(undistort_image(coords, K, d, model), reference)
+    if rotate_code is not None:
+        steps = cv.rotate(steps, rotate_code)
+    mapx, mapy = correction_maps(K, d, reference, size, rotate_code, map_type=cv.CV_32FC1, model=model)
+    # Ignore the output pixels where the multi-step path reached the image border
+    valid = steps[..., 2] > 0.999
+    error = np.hypot(steps[..., 0] - mapx, steps[..., 1] - mapy)[valid]
+    max_error = float(error.max()) if error.size else 0.0
+    if max_error > tolerance:
+        raise ValueError("Single pass correction differs from the multi-step correction by %.2f pixels" % max_error)
+    return max_error
+
+def build_maps(long_side=960):
+    """Computes all correction maps of the station (full resolution and preview) so they are saved in the profile
+    and no map computation is left for the next launches"""
+    cal = profile()
+    blank = np.zeros((frame_size[1], frame_size[0], 3), np.uint8)
+    cal.autosave = False
+    try:
+        acquire_images(blank, blank, cal.rotate)
+        preview_image(blank, blank, cal.rotate, long_side)
+    finally:
+        cal.autosave = True
+    if cal.path is not None:
+        cal.save()
+
+def encode_image(img, file_extension, image_dpi_value):
+    """Encodes an image in a single pass with its DPI embedded for printing
+    Returns the encoded file content"""
+    ext = file_extension.lower()
+    if ext in (".jpg", ".jpeg", ".png"):
+        ret_val, buf = cv.imencode(ext, img)
+        if not ret_val:
+            raise ValueError("Unable to encode image as " + file_extension)
+        data = bytearray(buf)
+        if ext == ".png":
+            #Add a pHYs chunk (pixels per meter) right after the IHDR chunk
+            ppm = int(round(image_dpi_value / 0.0254))
+            chunk = b"pHYs" + struct.pack(">IIB", ppm, ppm, 1)
+            data[33:33] = struct.pack(">I", 9) + chunk + struct.pack(">I", zlib.crc32(chunk) & 0xffffffff)
+        elif data[2:4] == b"\xff\xe0" and data[6:11] == b"JFIF\0":
+            #Set the density of the JFIF header written by OpenCV in dots per inch
+            data[13:18] = struct.pack(">BHH", 1, image_dpi_value, image_dpi_value)
+        return bytes(data)
+    #Other formats are encoded by Pillow
+    from PIL import Image
+    out = io.BytesIO()
+    Image.fromarray(cv.cvtColor(img, cv.COLOR_BGR2RGB)).save(out, format=Image.registered_extensions()[ext], dpi=(image_dpi_value, image_dpi_value))
+    return out.getvalue()
 
-def podonator(output_dir, left_camera_id, right_camera_id):
+def replace_file(tmp_path, path):
+    """Renames a complete temporary file to path, with the permissions of a file created normally (umask) instead of
+    the owner only permissions given by mkstemp"""
+    os.chmod(tmp_path, 0o666 & ~_umask)
+    os.replace(tmp_path, path)
+
+def write_arrays(path, **arrays):
+    """Writes arrays to an npz file through a unique temporary file renamed once complete, so an interrupted write
+    never leaves a truncated file (several processes can write the same file)"""
+    folder, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix="." + name, suffix=".tmp", dir=folder or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        replace_file(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def write_image(img, path, file_extension, image_dpi_value):
+    """Encodes an image and writes it atomically (temporary file renamed once complete)"""
+    data = encode_image(img, file_extension, image_dpi_value)
+    folder, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix="." + name, suffix=".tmp", dir=folder or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        replace_file(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return path
+
+def output_writer():
+    """Returns the background writer used for the output images (one thread per image of a pair)"""
+    global _output_writer # pylint: disable=global-statement
+    if _output_writer is None:
+        _output_writer = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="output")
+    return _output_writer
+
+def report_output_error(future):
+    """Prints the error of a failed background image (measurements or archive) write"""
+    if future.exception() is not None:
+        print("ERROR : Unable to write output :", future.exception())
+
+def measure_output(img, path, image_dpi_value, written):
+    """Writes the foot measurements of an output image once the image write (future) is done, so the measurements are
+    never older than the image (PodonatorMeasure.measure_all would measure it again)"""
+    import PodonatorMeasure
+    written.result()
+    return PodonatorMeasure.write_measures(img, path, image_dpi_value)
+
+def archive_images(naming_pattern, images, futures):
+    """Adds the written output images to the archive once they are written
+    images is a list of (camera suffix, image path, corrected image), futures are the image writes followed by the measurements"""
+    import PodonatorArchive
+    concurrent.futures.wait(futures)
+    measures = [None] * len(images)
+    if measure_outputs:
+        measures = [None if future.exception() else future.result() for future in futures[len(images):]]
+    written = [image + (measure,) for image, future, measure in zip(images, futures, measures) if future.exception() is None]
+    if written:
+        return PodonatorArchive.archive_capture(naming_pattern, written, patient)
+    return None
+
+def output_images(img1, img2, naming_pattern, file_extension, image_dpi_value, wait=True):
+    """Image generation, both images are encoded and written in parallel by the background writer
+    The foot measurements are written next to them if measure_outputs is True and the images are archived (with a thumbnail)
+    if archive_outputs is True
+    Returns the futures of the written paths, without waiting for them unless wait is True"""
+    naming_pattern = os.path.abspath(naming_pattern)
+    futures = [output_writer().submit(write_image, img1, naming_pattern+"_G"+file_extension, file_extension, image_dpi_value),
+               output_writer().submit(write_image, img2, naming_pattern+"_D"+file_extension, file_extension, image_dpi_value)]
+    if measure_outputs:
+        for img, suffix, written in ((img1, "_G", futures[0]), (img2, "_D", futures[1])):
+            futures.append(output_writer().submit(measure_output, img, naming_pattern+suffix+file_extension, image_dpi_value, written))
+    if archive_outputs:
+        images = [("_G", naming_pattern+"_G"+file_extension, img1), ("_D", naming_pattern+"_D"+file_extension, img2)]
+        futures.append(output_writer().submit(archive_images, naming_pattern, images, list(futures)))
+    for future in futures:
+        future.add_done_callback(report_output_error)
+    if wait:
+        concurrent.futures.wait(futures)
+    return futures
+
+def open_folder(folder):
+    """Opens the file browser in a folder (webbrowser is only imported when it is needed)"""
+    import webbrowser
+    webbrowser.open(str(Path(folder)))
+
+def podonator(output_dir, left_camera_id, right_camera_id, show_stats=False, record=None):
     """Calls all previous functions"""
     os.chdir(str(Path(output_dir)))
-    #Initialize cameras
-    cam1 = init_camera(left_camera_id)
-    cam2 = init_camera(right_camera_id)
+    #Get the cameras already opened by the camera pool
+    cam1 = camera_pool().get(left_camera_id)
+    cam2 = camera_pool().get(right_camera_id)
+    if cam1 is None or cam2 is None:
+        sys.exit("ERROR : One or more cameras unavailable")
     #Launch image preview, capture and correction
-    correct_img1, correct_img2, gen_output = show_images(cam1, cam2, rotate)
-    cam1.release()
-    cam2.release()
+    stats = PipelineStats() if show_stats else None
+    correct_img1, correct_img2, gen_output = show_images(cam1, cam2, profile().rotate, stats, record)
+    camera_pool().release()
     cv.destroyAllWindows()
+    now = datetime.datetime.now()
+    if stats is not None:
+        stats.dump(now.strftime("%Y-%m-%d-%H%M%S") + "_timing.json")
     if gen_output:
-        #Rotate images if necessary
-        if rotate:
-            correct_img1 = cv.rotate(correct_img1, cv.ROTATE_90_CLOCKWISE)
-            correct_img2 = cv.rotate(correct_img2, cv.ROTATE_90_COUNTERCLOCKWISE)
-        now = datetime.datetime.now()
         img_name = now.strftime("%Y-%m-%d-%H%M%S")
-        output_images(correct_img1, correct_img2, img_name, file_ext, image_dpi)
+        output_images(correct_img1, correct_img2, img_name, file_ext, profile().image_dpi, wait=False)
         #Open the file browser in the output folder
-        webbrowser.open(str(Path(output_dir)))
+        open_folder(output_dir)
         return
     return
+
+def output_size(camera_calibration, size=None, long_side=None):
+    """Returns the size (w, h) of the corrected image of a camera for a frame size (frame_size by default)
+    scaled so its long side is long_side pixels if given"""
+    w, h = size or frame_size
+    h = int(round(w * profile().image_ratio))
+    if camera_calibration.rotate_code in (cv.ROTATE_90_CLOCKWISE, cv.ROTATE_90_COUNTERCLOCKWISE):
+        w, h = h, w
+    if long_side:
+        scale = long_side / max(w, h)
+        w, h = int(round(w * scale)), int(round(h * scale))
+    return w, h
+
+def array_settings():
+    """Returns the module settings passed to the camera worker processes"""
+    return {name: globals()[name] for name in ("capture_backend", "frame_size", "frame_rate", "replay_speed", "file_ext",
+                                               "acquire_mode", "burst_size", "sharp_frames", "sharp_window", "archive_outputs",
+                                               "measure_outputs")}
+
+def camera_worker(index, camera_id, profile_path, settings, channel):
+    """Camera array worker process : reads a camera, corrects each frame at preview resolution into the shared preview
+    of the camera and corrects the acquired frame at full resolution and writes it (with its thumbnail for the archive
+    and its foot measurements if measure_outputs is True), errors are reported to the application through the results queue
+    channel holds the command and result queues and the shared preview (name, shape, lock, frame count, capture time)"""
+    from multiprocessing import shared_memory
+    commands, results, preview_name, preview_shape, lock, count, capture_time = channel
+    globals().update(settings)
+    #The maps were built and saved by the application, the workers never write the profile
+    load_profile(profile_path).autosave = False
+    cal = profile().camera(index)
+    cam = init_camera(camera_id)
+    if cam is None or not cam.isOpened():
+        results.put(("error", index, "No input from camera " + str(camera_id) + ", check camera ID"))
+        return
+    #Correction maps are loaded before the first frame
+    correction_maps(cal.K, cal.d, cal.reference, frame_size, cal.rotate_code, (preview_shape[1], preview_shape[0]), model=cal.model)
+    correction_maps(cal.K, cal.d, cal.reference, frame_size, cal.rotate_code, model=cal.model)
+    memory = shared_memory.SharedMemory(name=preview_name)
+    preview = np.ndarray(preview_shape, np.uint8, buffer=memory.buf)
+    new_frame = threading.Event()
+    grabber = FrameGrabber(cam, profile().mirror, new_frame=new_frame)
+    grabber.start()
+    results.put(("ready", index, None))
+    img = None
+    try:
+        while True:
+            if new_frame.wait(0.05):
+                new_frame.clear()
+                with grabber.condition:
+                    if grabber.failed:
+                        results.put(("error", index, "Camera " + str(camera_id) + " unavailable"))
+                        return
+                timestamp, img = grabber.latest()
+                small = correct_image(img, cal.K, cal.d, cal.reference, cal.rotate_code, (preview_shape[1], preview_shape[0]), cal.model)
+                with lock:
+                    preview[...] = small
+                    count.value += 1
+                    capture_time.value = timestamp
+            try:
+                command = commands.get_nowait()
+            except queue.Empty:
+                continue
+            if command[0] == "stop":
+                break
+            if command[0] == "acquire":
+                if img is None:
+                    results.put(("error", index, "No frame from camera " + str(camera_id) + " yet, images not acquired"))
+                    continue
+                #Full resolution correction only for the acquired frame
+                full = correct_image(acquire_frame(grabber, img), cal.K, cal.d, cal.reference, cal.rotate_code, model=cal.model)
+                path = write_image(full, command[1] + cal.suffix + file_ext, file_ext, profile().image_dpi)
+                measures = None
+                if measure_outputs:
+                    import PodonatorMeasure
+                    measures = PodonatorMeasure.write_measures(full, path, profile().image_dpi)
+                thumbnail = None
+                if archive_outputs:
+                    import PodonatorArchive
+                    thumbnail = PodonatorArchive.make_thumbnail(full)
+                results.put(("acquired", index, (cal.suffix, path, thumbnail, measures)))
+    except Exception as error: # pylint: disable=broad-except
+        results.put(("error", index, "Camera " + str(camera_id) + " : " + str(error)))
+    finally:
+        grabber.stop()
+        cam.release()
+        del preview
+        memory.close()
+
+class CameraArray:
+    """Array of cameras (camera_ids[0] is camera 1 of the calibration profile), each camera is read and corrected by its
+    own worker process so the throughput grows with the number of CPU cores
+    The corrected preview of each camera (long_side pixels) is shared with the application through shared memory"""
+    def __init__(self, camera_ids, long_side=480):
+        import multiprocessing
+        self.camera_ids = list(camera_ids)
+        self.long_side = long_side
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.workers = []
+
+    def start(self, timeout=30.0):
+        """Starts the worker processes and waits for all cameras to be opened, raises RuntimeError if a camera is unavailable"""
+        from multiprocessing import shared_memory
+        self.build_maps()
+        for index, camera_id in enumerate(self.camera_ids, 1):
+            w, h = output_size(profile().camera(index), long_side=self.long_side)
+            shape = (h, w, 3)
+            memory = shared_memory.SharedMemory(create=True, size=h * w * 3)
+            channel = (self.context.Queue(), self.results, memory.name, shape, self.context.Lock(),
+                       self.context.Value("L", 0, lock=False), self.context.Value("d", 0.0, lock=False))
+            process = self.context.Process(target=camera_worker, args=(index, camera_id, profile().path, array_settings(), channel), daemon=True)
+            process.start()
+            self.workers.append((process, memory, np.ndarray(shape, np.uint8, buffer=memory.buf), channel))
+        for _ in self.workers:
+            try:
+                kind, _, message = self.results.get(timeout=timeout)
+            except queue.Empty:
+                kind, message = "error", "Cameras not ready after %d s" % timeout
+            if kind == "error":
+                self.stop()
+                raise RuntimeError(message)
+
+    def build_maps(self):
+        """Builds the full resolution and preview correction maps of every camera and saves them once, before the
+        workers start, so they only load them"""
+        cal = profile()
+        cal.autosave = False
+        try:
+            for index in range(1, len(self.camera_ids) + 1):
+                camera = cal.camera(index)
+                correction_maps(camera.K, camera.d, camera.reference, frame_size, camera.rotate_code,
+                                output_size(camera, long_side=self.long_side), model=camera.model)
+                correction_maps(camera.K, camera.d, camera.reference, frame_size, camera.rotate_code, model=camera.model)
+        finally:
+            cal.autosave = True
+        if cal.path is not None and set(cal.maps) - cal.stored_maps:
+            try:
+                cal.save()
+            except OSError:
+                print("WARNING : Unable to save correction maps to", cal.path)
+
+    def check(self):
+        """Raises RuntimeError if a worker reported an error or ended (camera unavailable), called during the preview"""
+        while True:
+            try:
+                kind, _, message = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "error":
+                raise RuntimeError(message)
+        for camera_id, (process, _, _, _) in zip(self.camera_ids, self.workers):
+            if not process.is_alive():
+                #The error of the worker can still be on its way
+                try:
+                    kind, _, message = self.results.get(timeout=1.0)
+                except queue.Empty:
+                    kind = None
+                raise RuntimeError(message if kind == "error" else "Camera " + str(camera_id) + " unavailable")
+
+    def counts(self):
+        """Returns the number of previews corrected by each worker"""
+        return tuple(channel[5].value for _, _, _, channel in self.workers)
+
+    def previews(self):
+        """Returns a copy of the latest (capture time, corrected preview) of each camera"""
+        frames = []
+        for _, _, preview, channel in self.workers:
+            with channel[4]:
+                frames.append((channel[6].value, preview.copy()))
+        return frames
+
+    def acquire(self, naming_pattern, timeout=30.0):
+        """Acquires, corrects and writes the current frame of every camera (in parallel, each by its worker)
+        Returns the (camera suffix, path, JPEG thumbnail or None, foot measurements or None) of the written images,
+        raises RuntimeError if a camera failed or did not answer within timeout seconds"""
+        for _, _, _, channel in self.workers:
+            channel[0].put(("acquire", os.path.abspath(naming_pattern)))
+        images = {}
+        end = time.perf_counter() + timeout
+        while len(images) < len(self.workers):
+            try:
+                kind, index, message = self.results.get(timeout=0.5)
+            except queue.Empty:
+                self.check()
+                if time.perf_counter() > end:
+                    raise RuntimeError("Cameras did not answer within %d s, images not acquired" % timeout)
+                continue
+            if kind == "error":
+                raise RuntimeError(message)
+            images[index] = message
+        return [images[index] for index in sorted(images)]
+
+    def stop(self):
+        """Stops the worker processes (releasing the cameras) and frees the shared previews"""
+        for process, _, _, channel in self.workers:
+            if process.is_alive():
+                channel[0].put(("stop",))
+        for process, memory, _, _ in self.workers:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+            memory.close()
+            memory.unlink()
+        self.workers = []
+
+def tile_previews(previews):
+    """Returns the previews side by side in a single image (padded to the same height)"""
+    height = max(preview.shape[0] for preview in previews)
+    return np.concatenate([cv.copyMakeBorder(preview, 0, height - preview.shape[0], 0, 0, cv.BORDER_CONSTANT) for preview in previews], axis=1)
+
+def podonator_array(output_dir, camera_ids, show_stats=False):
+    """Camera array version of podonator, shows the stream from all cameras and writes one image per camera on capture"""
+    os.chdir(str(Path(output_dir)))
+    array = CameraArray(camera_ids)
+    try:
+        array.start()
+    except RuntimeError as error:
+        sys.exit("ERROR : " + str(error))
+    stats = PipelineStats() if show_stats else None
+    gen_output = False
+    last_count = None
+    try:
+        while True:
+            #A worker error (camera unavailable...) ends the preview instead of freezing the preview of its camera
+            array.check()
+            if last_count != array.counts():
+                last_count = array.counts()
+                previews = array.previews()
+                img = tile_previews([preview for _, preview in previews])
+                timestamp = min(capture_time for capture_time, _ in previews)
+                if stats is not None:
+                    stats.overlay(img)
+                    stats.frame(timestamp)
+                cv.imshow("Podoscope Preview - Spacebar to acquire or Esc to cancel", img)
+            keypress = cv.waitKey(1)
+            if keypress%256 == 27:
+                print("Cancelled")
+                break
+            if keypress%256 == 32:
+                gen_output = True
+                break
+        now = datetime.datetime.now()
+        if gen_output:
+            images = array.acquire(now.strftime("%Y-%m-%d-%H%M%S"))
+            print("Images acquired :", ", ".join(path for _, path, _, _ in images))
+            if archive_outputs:
+                import PodonatorArchive
+                PodonatorArchive.archive_capture(now.strftime("%Y-%m-%d-%H%M%S"), images, patient)
+    except RuntimeError as error:
+        sys.exit("ERROR : " + str(error))
+    finally:
+        array.stop()
+        cv.destroyAllWindows()
+    if stats is not None:
+        stats.dump(now.strftime("%Y-%m-%d-%H%M%S") + "_timing.json")
+    if gen_output:
+        open_folder(output_dir)
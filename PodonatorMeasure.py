@@ -0,0 +1,161 @@
+import sys
+import getopt
+import glob
+import json
+import time
+import struct
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import cv2 as cv
+import PodonatorLib
+
+
+'''
+usage:
+    PodonatorMeasure.py [--processes] [--profile] [--dpi] [--force] <corrected images folder or glob>
+
+default values:
+    --processes : number of CPU cores
+    --profile   : PODONATOR_PROFILE environment variable or podonator_profile.npz next to PodonatorLib.py
+    --dpi       : resolution stored in the image (JPEG), image_dpi of the calibration profile otherwise
+
+Measures the foot on corrected images (output of Podonator or PodonatorBatch) and writes the measurements in millimeters
+to <image name>.json next to each image. Images already measured are skipped unless --force is used.
+'''
+
+# Length of the slices of the foot used for the width profile (mm)
+slice_mm = 1.0
+# Smoothing of the width profile (mm)
+smoothing_mm = 5.0
+# Foot components smaller than this fraction of the largest one are ignored (dust, reflections)
+min_component = 0.05
+
+def image_dpi(path):
+    """Returns the resolution stored in the JFIF header of a JPEG image, None if there is none"""
+    try:
+        with open(str(path), "rb") as f:
+            header = f.read(18)
+    except OSError:
+        return None
+    if header[2:4] == b"\xff\xe0" and header[6:11] == b"JFIF\0" and header[13] == 1:
+        return struct.unpack(">H", header[14:16])[0]
+    return None
+
+def foot_mask(img):
+    """Segments the foot (Otsu threshold, the background being the class covering most of the image border)
+    Returns the foot mask, holes filled"""
+    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    gray = cv.GaussianBlur(gray, (5, 5), 0)
+    _, mask = cv.threshold(gray, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    border = np.concatenate((mask[0], mask[-1], mask[:, 0], mask[:, -1]))
+    if np.count_nonzero(border) > border.size // 2:
+        mask = cv.bitwise_not(mask)
+    kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (7, 7))
+    mask = cv.morphologyEx(mask, cv.MORPH_OPEN, kernel)
+    contours = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)[-2]
+    foot = np.zeros_like(mask)
+    if not contours:
+        return foot
+    largest = max(cv.contourArea(contour) for contour in contours)
+    #Heel, forefoot and toes are separate components on a high arch footprint
+    contours = [contour for contour in contours if cv.contourArea(contour) >= min_component * largest]
+    cv.drawContours(foot, contours, -1, 255, cv.FILLED)
+    return foot
+
+def measure_foot(img, dpi):
+    """Measures the foot on a corrected image, dpi is the image resolution
+    Length along the main axis of the foot, widths across it from the contact width profile (one value per slice_mm)
+    Arch indexes : Chippaux-Smirak (min midfoot width / max forefoot width), Staheli (min midfoot width / max heel width)
+    and Cavanagh arch index (midfoot area / total area, the foot length being split in thirds)
+    Returns a dictionary of the measurements (mm, mm2 and ratios), None if no foot was found"""
+    mm_per_pixel = 25.4 / dpi
+    ys, xs = np.nonzero(foot_mask(img))
+    if xs.size < 100:
+        return None
+    points = np.column_stack((xs, ys)).astype(np.float64)
+    center = points.mean(axis=0)
+    points -= center
+    #Main axis of the foot
+    _, vectors = np.linalg.eigh(points.T @ points)
+    u = points @ vectors[:, 1] * mm_per_pixel
+    u -= u.min()
+    length = float(u.max())
+    #Contact width of each slice
+    bins = np.minimum((u / slice_mm).astype(np.int64), int(length / slice_mm))
+    widths = np.bincount(bins) * mm_per_pixel ** 2 / slice_mm
+    kernel_size = max(1, int(round(smoothing_mm / slice_mm)))
+    widths = np.convolve(widths, np.ones(kernel_size) / kernel_size, mode="same")
+    #Heel first : the forefoot is the widest part of the foot
+    if np.argmax(widths) < widths.size / 2:
+        widths = widths[::-1]
+        bins = bins.max() - bins
+    third = widths.size / 3.0
+    heel, midfoot, forefoot = widths[:int(third)], widths[int(third):int(2 * third)], widths[int(2 * third):]
+    if not (heel.size and midfoot.size and forefoot.size):
+        return None
+    counts = np.bincount(np.minimum((bins / third).astype(np.int64), 2), minlength=3)
+    return {
+        "length_mm": length,
+        "width_mm": float(forefoot.max()),
+        "heel_width_mm": float(heel.max()),
+        "midfoot_width_mm": float(midfoot.min()),
+        "area_mm2": float(xs.size * mm_per_pixel ** 2),
+        "chippaux_smirak_index": float(midfoot.min() / forefoot.max()),
+        "staheli_index": float(midfoot.min() / heel.max()),
+        "arch_index": float(counts[1] / counts.sum()),
+        "axis_angle_deg": float(np.degrees(np.arctan2(vectors[1, 1], vectors[0, 1])) % 180),
+    }
+
+def write_measures(img, path, dpi):
+    """Measures the foot of a corrected image and writes the measurements to <image name>.json next to the image path
+    Returns the measurements"""
+    measures = measure_foot(img, dpi)
+    result = {"image": Path(path).name, "dpi": dpi, "foot": measures}
+    Path(path).with_suffix(".json").write_text(json.dumps(result, indent=1))
+    return measures
+
+def measure_image(job):
+    """Worker : measures a corrected image and writes its measurements
+    Returns the image path and the measurements (None if the image could not be read or no foot was found)"""
+    path, dpi = job
+    img = cv.imread(str(path))
+    if img is None:
+        return path, None
+    dpi = dpi or image_dpi(path) or PodonatorLib.profile().image_dpi
+    return path, write_measures(img, path, dpi)
+
+def find_images(pattern):
+    """Returns the corrected images matching a folder or a glob"""
+    if Path(pattern).is_dir():
+        pattern = str(Path(pattern).joinpath("*"))
+    return [Path(path) for path in sorted(glob.glob(pattern)) if Path(path).suffix.lower() in PodonatorLib.image_extensions]
+
+def measure_all(pattern, processes=None, force=False, dpi=None, profile_path=None):
+    """Measures all corrected images matching pattern with a process pool, skipping images already measured"""
+    PodonatorLib.load_profile(profile_path)
+    images = find_images(pattern)
+    jobs = [(path, dpi) for path in images
+            if force or not path.with_suffix(".json").exists() or path.with_suffix(".json").stat().st_mtime_ns < path.stat().st_mtime_ns]
+    print("%d images found, %d up to date, %d to measure" % (len(images), len(images) - len(jobs), len(jobs)))
+    if not jobs:
+        return
+    start = time.perf_counter()
+    with multiprocessing.Pool(processes, PodonatorLib.load_profile, (profile_path,)) as pool:
+        for count, (path, measures) in enumerate(pool.imap_unordered(measure_image, jobs, chunksize=4), 1):
+            if measures is None:
+                print("[%d/%d] %s : no foot found" % (count, len(jobs), path.name))
+            else:
+                print("[%d/%d] %s : length %.1f mm, width %.1f mm, Chippaux-Smirak index %.2f"
+                      % (count, len(jobs), path.name, measures["length_mm"], measures["width_mm"], measures["chippaux_smirak_index"]))
+    elapsed = time.perf_counter() - start
+    print("Measured %d images in %.1f s : %.2f images/s" % (len(jobs), elapsed, len(jobs) / elapsed))
+
+if __name__ == '__main__':
+    args, pattern = getopt.getopt(sys.argv[1:], '', ['processes=', 'profile=', 'dpi=', 'force'])
+    args = dict(args)
+    if not pattern:
+        sys.exit("usage: PodonatorMeasure.py [--processes] [--profile] [--dpi] [--force] <corrected images folder or glob>")
+    processes = int(args['--processes']) if '--processes' in args else None
+    dpi = int(args['--dpi']) if '--dpi' in args else None
+    measure_all(pattern[0], processes, '--force' in args, dpi, args.get('--profile'))
@@ -0,0 +1,335 @@
+import sys
+import os
+import getopt
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import json
+import time
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import cv2 as cv
+import PodonatorLib
+
+
+'''
+usage:
+    PodonatorService.py [--host] [--port] [--processes] [--queue] [--profile] [--measure]
+                        [--left_camera_id --right_camera_id] [--backend] [<output path>]
+
+default values:
+    --host      : 127.0.0.1 (only reachable from the station, use 0.0.0.0 to accept other stations)
+    --port      : 8765
+    --processes : number of CPU cores
+    --queue     : 8 (pairs waiting for a worker, new jobs are refused with 503 when it is full)
+    --profile   : PODONATOR_PROFILE environment variable or podonator_profile.npz next to PodonatorLib.py
+    <output path> : .
+
+Headless capture and correction service. Captures are only available when camera IDs are given (a video file or an
+image sequence can be used instead of a camera). Local HTTP API (JSON) :
+    POST /capture                 captures a pair from the cameras and queues its correction (optional body {"patient": ...})
+    POST /jobs                    queues the correction of a raw pair {"name": ..., "left": <base64 image file>, "right": <base64 image file>,
+                                  "patient": ... (optional)}
+    GET  /jobs/<id>               job state (queued, running, done or failed) and output images
+    GET  /outputs/<file name>     corrected image (or measurements)
+    GET  /archive                 archived captures, newest first (?patient=...&station=...&limit=...&offset=...)
+    GET  /thumbnails/<image id>   thumbnail of an archived image
+    GET  /status                  queue depth, workers, job counts and timing statistics
+'''
+
+# Largest request body accepted (raw pair submitted as base64 encoded image files)
+max_body_size = 128 * 1024 * 1024
+# Number of finished jobs kept for /jobs/<id>
+job_history = 1000
+# HTTP reason phrases of the status codes used by the service
+reasons = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+def decode_image(raw):
+    """Returns the image of an encoded image file (bytes) or the image itself"""
+    if isinstance(raw, bytes):
+        return cv.imdecode(np.frombuffer(raw, np.uint8), cv.IMREAD_COLOR)
+    return raw
+
+def correct_job(name, raw1, raw2, output_dir, mirror_bool, measure, patient=None):
+    """Process pool worker : corrects a raw pair (images or encoded image files), writes the output images and archives them
+    Returns the names of the written files"""
+    img1 = decode_image(raw1)
+    img2 = decode_image(raw2)
+    if img1 is None or img2 is None:
+        raise ValueError("Unable to decode the raw images")
+    cal = PodonatorLib.profile()
+    if mirror_bool:
+        img1 = cv.flip(img1, 1)
+        img2 = cv.flip(img2, 1)
+    correct_img1, correct_img2 = PodonatorLib.acquire_images(img1, img2, cal.rotate)
+    outputs = []
+    images = []
+    for img, suffix in ((correct_img1, "_G"), (correct_img2, "_D")):
+        path = Path(output_dir).joinpath(name + suffix + PodonatorLib.file_ext)
+        PodonatorLib.write_image(img, str(path), PodonatorLib.file_ext, cal.image_dpi)
+        outputs.append(path.name)
+        measures = None
+        if measure:
+            import PodonatorMeasure
+            measures = PodonatorMeasure.write_measures(img, str(path), cal.image_dpi)
+            outputs.append(path.with_suffix(".json").name)
+        images.append((suffix, path, img, measures))
+    if PodonatorLib.archive_outputs:
+        import PodonatorArchive
+        PodonatorArchive.archive_capture(str(Path(output_dir).joinpath(name)), images, patient)
+    return outputs
+
+class PodonatorService:
+    """Capture and correction service : HTTP commands are handled by asyncio, corrections run on a bounded process pool
+    cameras is an optional (left camera ID, right camera ID) tuple enabling captures"""
+    def __init__(self, output_dir, processes=None, queue_size=8, profile_path=None, cameras=None, measure=False):
+        self.output_dir = Path(output_dir)
+        self.profile_path = profile_path
+        self.processes = processes or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.cameras = cameras
+        self.measure = measure
+        self.queue = None # Created in the event loop
+        self.pool = None
+        self.stereo = None
+        self.jobs = collections.OrderedDict() # Job ID : job state
+        self.job_ids = itertools.count(1)
+        self.busy = 0 # Workers correcting a pair
+        self.counts = collections.Counter() # Jobs submitted, done, failed and rejected
+        self.stats = PodonatorLib.PipelineStats(window=200)
+
+    def start_cameras(self):
+        """Opens the cameras and reads them continuously, so a capture does not wait for the cameras to start"""
+        left_camera_id, right_camera_id = self.cameras
+        available = PodonatorLib.camera_pool().probe([left_camera_id, right_camera_id])
+        if left_camera_id not in available or right_camera_id not in available:
+            sys.exit("ERROR : One or more cameras unavailable")
+        cam1 = PodonatorLib.camera_pool().get(left_camera_id)
+        cam2 = PodonatorLib.camera_pool().get(right_camera_id)
+        self.stereo = PodonatorLib.StereoGrabber(cam1, cam2, PodonatorLib.profile().mirror)
+        self.stereo.start()
+
+    def submit(self, name, raw1, raw2, mirror_bool, patient=None):
+        """Queues the correction of a raw pair
+        Returns the job, None if the queue is full"""
+        if self.queue.full():
+            self.counts["rejected"] += 1
+            return None
+        job_id = next(self.job_ids)
+        job = {"id": job_id, "name": name or datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S") + "-" + str(job_id),
+               "state": "queued", "submitted": time.time(), "patient": patient, "outputs": []}
+        self.jobs[job_id] = job
+        while len(self.jobs) > job_history:
+            self.jobs.popitem(last=False)
+        self.queue.put_nowait((job, raw1, raw2, mirror_bool, patient, time.perf_counter()))
+        self.counts["submitted"] += 1
+        return job
+
+    async def worker(self):
+        """Takes the queued jobs one at a time and runs them on the process pool"""
+        loop = asyncio.get_running_loop()
+        while True:
+            job, raw1, raw2, mirror_bool, patient, queued = await self.queue.get()
+            self.stats.add("queue_wait", time.perf_counter() - queued)
+            job["state"] = "running"
+            self.busy += 1
+            start = time.perf_counter()
+            try:
+                job["outputs"] = await loop.run_in_executor(self.pool, correct_job, job["name"], raw1, raw2,
+                                                            str(self.output_dir), mirror_bool, self.measure, patient)
+                job["state"] = "done"
+                self.counts["done"] += 1
+            except Exception as error: # pylint: disable=broad-except
+                job["state"] = "failed"
+                job["error"] = str(error)
+                self.counts["failed"] += 1
+            finally:
+                self.busy -= 1
+                self.stats.add("correction", time.perf_counter() - start)
+                self.queue.task_done()
+
+    def status(self):
+        """Returns the service metrics"""
+        return {"queue_depth": self.queue.qsize(), "queue_size": self.queue_size, "workers": self.processes,
+                "busy_workers": self.busy, "capture": self.stereo is not None, "jobs": dict(self.counts),
+                "timing": self.stats.summary()["stages"]}
+
+    async def capture(self, body):
+        """Captures a synchronized pair from the cameras
+        Returns the (status, response) of the capture command"""
+        try:
+            patient = json.loads(body).get("patient") if body else None
+        except (ValueError, AttributeError):
+            return 400, {"error": "Expected a JSON object"}
+        if patient is not None and not isinstance(patient, str):
+            return 400, {"error": "Invalid patient"}
+        if self.stereo is None:
+            return 409, {"error": "No cameras, start the service with --left_camera_id and --right_camera_id"}
+        pair = await asyncio.get_running_loop().run_in_executor(None, self.stereo.synced_pair)
+        if pair is None:
+            return 409, {"error": "Left and right frames more than %d ms apart" % (PodonatorLib.max_skew * 1000)}
+        job = self.submit(None, pair[1], pair[3], False, patient)
+        if job is None:
+            return 503, {"error": "Queue full"}
+        return 202, job
+
+    def submit_pair(self, body):
+        """Queues a raw pair sent as base64 encoded image files
+        Returns the (status, response) of the submit command"""
+        try:
+            request = json.loads(body)
+            raw1 = base64.b64decode(request["left"])
+            raw2 = base64.b64decode(request["right"])
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": "Expected a JSON object with base64 encoded left and right images"}
+        name = request.get("name")
+        if name is not None and (not isinstance(name, str) or Path(name).name != name):
+            return 400, {"error": "Invalid name"}
+        patient = request.get("patient")
+        if patient is not None and not isinstance(patient, str):
+            return 400, {"error": "Invalid patient"}
+        job = self.submit(name, raw1, raw2, PodonatorLib.profile().mirror, patient)
+        if job is None:
+            return 503, {"error": "Queue full"}
+        return 202, job
+
+    def archive(self, query):
+        """Returns the (status, response) of an archive query"""
+        criteria = {name: values[-1] for name, values in parse_qs(query).items()}
+        try:
+            limit, offset = int(criteria.get("limit", 50)), int(criteria.get("offset", 0))
+        except ValueError:
+            return 400, {"error": "Invalid limit or offset"}
+        import PodonatorArchive
+        with PodonatorArchive.Archive(self.output_dir) as archive:
+            captures = archive.query(criteria.get("patient"), criteria.get("station"), limit=limit, offset=offset)
+        #Image files are served by /outputs
+        for capture in captures:
+            for image in capture["images"]:
+                image["path"] = Path(image["path"]).name
+        return 200, captures
+
+    def thumbnail(self, image_id):
+        """Returns the (status, response) of a thumbnail request"""
+        import PodonatorArchive
+        with PodonatorArchive.Archive(self.output_dir) as archive:
+            data = archive.thumbnail(image_id)
+        if data is None:
+            return 404, {"error": "Unknown image"}
+        return 200, data
+
+    async def route(self, method, path, body):
+        """Runs an HTTP command
+        Returns the status, the response (JSON object or file content) and its content type"""
+        url = urlsplit(path)
+        parts = [part for part in url.path.split("/") if part]
+        if parts == ["status"] and method == "GET":
+            return 200, self.status(), "application/json"
+        if parts == ["capture"] and method == "POST":
+            return (await self.capture(body)) + ("application/json",)
+        if parts == ["jobs"] and method == "POST":
+            return self.submit_pair(body) + ("application/json",)
+        if len(parts) == 2 and parts[0] == "jobs" and method == "GET":
+            job = self.jobs.get(int(parts[1])) if parts[1].isdigit() else None
+            if job is None:
+                return 404, {"error": "Unknown job"}, "application/json"
+            return 200, job, "application/json"
+        if len(parts) == 2 and parts[0] == "outputs" and method == "GET":
+            #Only the corrected images and measurements of the output folder itself are served (not the archive database)
+            name = parts[1]
+            path = self.output_dir.joinpath(name)
+            if (Path(name).name != name or "\\" in name or path.suffix.lower() not in PodonatorLib.image_extensions + [".json"]
+                    or path.resolve().parent != self.output_dir.resolve() or not path.is_file()):
+                return 404, {"error": "Unknown output"}, "application/json"
+            content_type = "application/json" if path.suffix == ".json" else "image/" + path.suffix.lstrip(".").replace("jpg", "jpeg")
+            return 200, path.read_bytes(), content_type
+        if parts == ["archive"] and method == "GET":
+            return self.archive(url.query) + ("application/json",)
+        if len(parts) == 2 and parts[0] == "thumbnails" and method == "GET":
+            status, response = self.thumbnail(int(parts[1])) if parts[1].isdigit() else (404, {"error": "Unknown image"})
+            return status, response, "image/jpeg" if status == 200 else "application/json"
+        if parts and parts[0] in ("status", "capture", "jobs", "outputs", "archive", "thumbnails"):
+            return 405, {"error": "Method not allowed"}, "application/json"
+        return 404, {"error": "Unknown command"}, "application/json"
+
+    async def handle(self, reader, writer):
+        """Handles an HTTP connection (one request per connection)"""
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ("\r\n", "\n", ""):
+                    break
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if len(request_line) < 2:
+                status, response, content_type = 400, {"error": "Invalid request"}, "application/json"
+            elif length > max_body_size:
+                status, response, content_type = 413, {"error": "Request too large"}, "application/json"
+            else:
+                body = await reader.readexactly(length) if length else b""
+                status, response, content_type = await self.route(request_line[0].upper(), request_line[1], body)
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            status, response, content_type = 400, {"error": "Invalid request"}, "application/json"
+        except Exception as error: # pylint: disable=broad-except
+            #Any other error (archive database, file system...) is reported instead of dropping the connection
+            status, response, content_type = 500, {"error": str(error)}, "application/json"
+        if not isinstance(response, bytes):
+            response = json.dumps(response).encode()
+        header = "HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n" % (status, reasons[status], content_type, len(response))
+        if status == 503:
+            header += "Retry-After: 1\r\n"
+        try:
+            writer.write(header.encode() + b"\r\n" + response)
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        """Runs the service until it is interrupted"""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        #Build (or load) the correction maps once before the workers load them from disk
+        blank = np.zeros((PodonatorLib.frame_size[1], PodonatorLib.frame_size[0], 3), np.uint8)
+        PodonatorLib.acquire_images(blank, blank, PodonatorLib.profile().rotate)
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.processes, initializer=PodonatorLib.load_profile, initargs=(self.profile_path,))
+        if self.cameras is not None:
+            self.start_cameras()
+        workers = [asyncio.ensure_future(self.worker()) for _ in range(self.processes)]
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Podonator service listening on http://%s:%d (%d workers, queue of %d pairs)" % (host, port, self.processes, self.queue_size))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if self.stereo is not None:
+                self.stereo.stop()
+            PodonatorLib.camera_pool().release()
+            self.pool.shutdown()
+
+if __name__ == '__main__':
+    args, output_dir = getopt.getopt(sys.argv[1:], '', ['host=', 'port=', 'processes=', 'queue=', 'profile=', 'measure',
+                                                        'left_camera_id=', 'right_camera_id=', 'backend='])
+    args = dict(args)
+    PodonatorLib.load_profile(args.get('--profile'))
+    if '--backend' in args:
+        PodonatorLib.capture_backend = args.get('--backend')
+    cameras = None
+    if '--left_camera_id' in args or '--right_camera_id' in args:
+        cameras = (PodonatorLib.camera_id_value(args.get('--left_camera_id', 0)), PodonatorLib.camera_id_value(args.get('--right_camera_id', 1)))
+    service = PodonatorService(output_dir[0] if output_dir else ".", int(args['--processes']) if '--processes' in args else None,
+                               int(args.get('--queue', 8)), args.get('--profile'), cameras, '--measure' in args)
+    try:
+        asyncio.run(service.serve(args.get('--host', '127.0.0.1'), int(args.get('--port', 8765))))
+    except KeyboardInterrupt:
+        print("Podonator service stopped")